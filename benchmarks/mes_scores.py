@@ -0,0 +1,97 @@
+#! /usr/bin/env python
+# -*- coding: utf8 -*-
+
+# This file is part of table_maker.py
+
+# Copyright Institut Curie 2014
+
+# This software is a computer program whose purpose is to MaxEntScan scores.
+
+# This software is governed by the CeCILL license under French law and
+# abiding by the rules of distribution of free software.  You can  use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# "http://www.cecill.info".
+
+# As a counterpart to the access to the source code and  rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty  and the software's author,  the holder of the
+# economic rights,  and the successive licensors  have only  limited
+# liability.
+
+# In this respect, the user's attention is drawn to the risks associated
+# with loading,  using,  modifying and/or developing or reproducing the
+# software by the user in light of its specific status of free software,
+# that may mean  that it is complicated to manipulate,  and  that  also
+# therefore means  that it is reserved for developers  and  experienced
+# professionals having in-depth computer knowledge. Users are therefore
+# encouraged to load and test the software's suitability as regards their
+# requirements in conditions enabling the security of their systems and/or
+# data to be ensured and,  more generally, to use and operate it in the
+# same conditions as regards security.
+
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+import optparse, sys, os, random, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import clinTools
+
+MES_SCRIPT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'maxentscan/')
+
+
+def getRandomSequences(nSeq, seqSize, seed):
+
+    """Random sequences, acceptor 23-mers get the AG of the splice site at positions 19 and 20"""
+
+    rng = random.Random(seed)
+    seqList = list()
+    for i in xrange(nSeq):
+        seq = ''.join(rng.choice('ACGT') for j in xrange(seqSize))
+        if seqSize == 23:
+            seq = seq[:18] + 'AG' + seq[20:]
+        seqList.append(seq)
+
+    return seqList
+
+
+parser = optparse.OptionParser(usage="%prog [options]",
+    description="Time the vectorized maxentscan acceptor (23-mers) and donor (9-mers) scoring on batches of random sequences")
+parser.add_option(
+    "-b", "--batch-sizes", default="1,32,1000,100000", type=str,
+    help="Comma separated list of batch sizes, a batch is scored in one call (default : 1,32,1000,100000)"
+)
+parser.add_option(
+    "-n", "--sequences", default=200000, type=int,
+    help="Minimum number of sequences scored for each batch size (default : 200000)"
+)
+parser.add_option(
+    "-r", "--repeat", default=5, type=int,
+    help="Number of timed runs of each batch size, the best time is reported (default : 5)"
+)
+parser.add_option(
+    "-s", "--seed", default=1, type=int,
+    help="Seed of the random sequence generator (default : 1)"
+)
+(options, args) = parser.parse_args()
+
+# models are loaded (and compiled if needed) before timing
+clinTools.loadMesModels(MES_SCRIPT_DIR)
+
+print '\t'.join(['model', 'batch_size', 'calls', 'microseconds_per_call', 'sequences_per_ms'])
+for model, seqSize, scoreFunction in (('acceptor', 23, clinTools.getMesAcceptorScoreArray), ('donor', 9, clinTools.getMesDonorScoreArray)):
+    for batchSize in [int(batchSize) for batchSize in options.batch_sizes.split(',')]:
+        nCall = max(1, options.sequences // batchSize)
+        batchList = [getRandomSequences(batchSize, seqSize, options.seed + i) for i in xrange(min(nCall, 100))]
+
+        bestTime = None
+        for i in xrange(options.repeat):
+            startTime = time.time()
+            for j in xrange(nCall):
+                scoreFunction(batchList[j % len(batchList)], MES_SCRIPT_DIR)
+            elapsedTime = time.time() - startTime
+            if bestTime is None or elapsedTime < bestTime:
+                bestTime = elapsedTime
+
+        print '\t'.join([model, str(batchSize), str(nCall), '%.1f' % (bestTime / nCall * 1e6), '%.0f' % (nCall * batchSize / (bestTime * 1e3))])
@@ -0,0 +1,101 @@
+#! /usr/bin/env python
+# -*- coding: utf8 -*-
+
+# This file is part of table_maker.py
+
+# Copyright Institut Curie 2014
+
+# This software is a computer program whose purpose is to MaxEntScan scores.
+
+# This software is governed by the CeCILL license under French law and
+# abiding by the rules of distribution of free software.  You can  use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# "http://www.cecill.info".
+
+# As a counterpart to the access to the source code and  rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty  and the software's author,  the holder of the
+# economic rights,  and the successive licensors  have only  limited
+# liability.
+
+# In this respect, the user's attention is drawn to the risks associated
+# with loading,  using,  modifying and/or developing or reproducing the
+# software by the user in light of its specific status of free software,
+# that may mean  that it is complicated to manipulate,  and  that  also
+# therefore means  that it is reserved for developers  and  experienced
+# professionals having in-depth computer knowledge. Users are therefore
+# encouraged to load and test the software's suitability as regards their
+# requirements in conditions enabling the security of their systems and/or
+# data to be ensured and,  more generally, to use and operate it in the
+# same conditions as regards security.
+
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+import optparse, sys, os, random, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import clinTools
+
+
+def getSyntheticPileupLine(depth, indelRate, seed):
+
+    """Build a mpileup line of the given depth with matches, mismatches, read starts / ends, deletions and indels"""
+
+    rng = random.Random(seed)
+    tokenList = list()
+    for i in xrange(depth):
+        token = rng.choice('.....,,,,,AaCcGgTtNn*')
+        if rng.random() < 0.05:
+            token = '^' + chr(rng.randint(33, 93)) + token
+        if rng.random() < indelRate:
+            indelSeq = ''.join(rng.choice('ACGT') for j in xrange(rng.randint(1, 10)))
+            if token[-1] in ',acgtn':
+                indelSeq = indelSeq.lower()
+            token += rng.choice('+-') + str(len(indelSeq)) + indelSeq
+        if rng.random() < 0.05:
+            token += '$'
+        tokenList.append(token)
+
+    return '\t'.join(['chr1', '1000', 'A', str(depth), ''.join(tokenList), '*']) + '\n'
+
+
+parser = optparse.OptionParser(usage="%prog [options]",
+    description="Time clinTools.parsePileupLine on synthetic ultra-deep mpileup columns")
+parser.add_option(
+    "-d", "--depths", default="10000,100000,1000000", type=str,
+    help="Comma separated list of column depths (default : 10000,100000,1000000)"
+)
+parser.add_option(
+    "-i", "--indel-rate", default=0.05, type=float,
+    help="Fraction of reads followed by an indel (default : 0.05)"
+)
+parser.add_option(
+    "-r", "--repeat", default=5, type=int,
+    help="Number of timed parses of each column, the best time is reported (default : 5)"
+)
+parser.add_option(
+    "-s", "--seed", default=1, type=int,
+    help="Seed of the random column generator (default : 1)"
+)
+(options, args) = parser.parse_args()
+
+print '\t'.join(['depth', 'characters', 'seconds', 'reads_per_second'])
+for depth in [int(depth) for depth in options.depths.split(',')]:
+    pileupLine = getSyntheticPileupLine(depth, options.indel_rate, options.seed)
+
+    bestTime = None
+    for i in xrange(options.repeat):
+        startTime = time.time()
+        pileupDict = clinTools.parsePileupLine(pileupLine)
+        elapsedTime = time.time() - startTime
+        if bestTime is None or elapsedTime < bestTime:
+            bestTime = elapsedTime
+
+    # every read counts once in the depth, twice if it is followed by an indel
+    nIndel = sum(sum(countList) for countList in pileupDict['ins'].values()) + sum(sum(countList) for key, countList in pileupDict['del'].items() if key != '*')
+    if pileupDict['depth'] != depth + nIndel:
+        raise Exception("unexpected depth {0} for a column of {1} reads".format(pileupDict['depth'], depth))
+
+    print '\t'.join([str(depth), str(len(pileupLine)), '%.4f' % bestTime, '%.0f' % (depth / max(bestTime, 1e-9))])
@@ -0,0 +1,170 @@
+#! /usr/bin/env python
+# -*- coding: utf8 -*-
+
+# This file is part of table_maker.py
+
+# Copyright Institut Curie 2014
+
+# This software is a computer program whose purpose is to MaxEntScan scores.
+
+# This software is governed by the CeCILL license under French law and
+# abiding by the rules of distribution of free software.  You can  use, 
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# "http://www.cecill.info". 
+
+# As a counterpart to the access to the source code and  rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty  and the software's author,  the holder of the
+# economic rights,  and the successive licensors  have only  limited
+# liability. 
+
+# In this respect, the user's attention is drawn to the risks associated
+# with loading,  using,  modifying and/or developing or reproducing the
+# software by the user in light of its specific status of free software,
+# that may mean  that it is complicated to manipulate,  and  that  also
+# therefore means  that it is reserved for developers  and  experienced
+# professionals having in-depth computer knowledge. Users are therefore
+# encouraged to load and test the software's suitability as regards their
+# requirements in conditions enabling the security of their systems and/or 
+# data to be ensured and,  more generally, to use and operate it in the 
+# same conditions as regards security. 
+
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+
+import os
+import optparse
+import numpy
+import pysam
+
+import clinTools
+
+## Get options and read useful conf files
+parser = optparse.OptionParser(description="Precompute canonical and cryptic maxentscan scores and ESR scores of the 3 possible snv at each position of a panel. The table is used by table_maker.py with the --snv-table option, only indels and snv outside the panel are then computed during table_maker runs.",
+    usage="usage: %prog [options] bed_file prefered_nm_file_conf annotation_gtf reference_fasta_file output_prefix"
+)
+(options, args) = parser.parse_args()
+
+if len(args) < 5:
+    parser.print_help()
+    exit(1)
+
+bedFileName = args[0]
+preferedNmFile = args[1]
+gtfFileName = args[2]
+refFastaFileName = args[3]
+outputPrefix = args[4]
+
+mesScriptDir = os.path.dirname(os.path.realpath(__file__)) + "/maxentscan/"
+scoreTablePath = os.path.dirname(os.path.realpath(__file__)) + "/score_tables/"
+
+REF_FASTA = pysam.Fastafile(refFastaFileName)
+esrScoreArray = clinTools.loadESRScores(scoreTablePath + "ESRscore.tsv")
+
+# create prefered nm list
+preferedNmList = list()
+with open(preferedNmFile, 'r') as pNmF:
+    for line in pNmF:
+        preferedNmList.append(line.rstrip().split('\t')[0])
+
+# only the prefered nm are used
+transcriptStore = clinTools.loadChrGtf(gtfFileName, set(preferedNmList))
+
+# get bed regions (0-based) and merge overlapping regions
+regionDict = dict()
+with open(bedFileName, 'r') as bedFile:
+    for line in bedFile:
+        if not line.strip() or line.startswith(('#', 'track', 'browser')):
+            continue
+        lineList = line.rstrip().split('\t')
+        regionDict.setdefault(lineList[0], list()).append([int(lineList[1]), int(lineList[2])])
+
+regionList = list()
+for chrom in sorted(regionDict.keys()):
+    mergedList = list()
+    for start, end in sorted(regionDict[chrom]):
+        if mergedList and start <= mergedList[-1][1]:
+            mergedList[-1][1] = max(mergedList[-1][1], end)
+        else:
+            mergedList.append([start, end])
+    regionList.extend([(chrom, start, end) for start, end in mergedList])
+
+# span (0-based, first to last base of the exons) of prefered nm on each chromosome
+nmSpanDict = dict()
+for chrom in transcriptStore.getChromosomes():
+    for nm in preferedNmList:
+        transcript = transcriptStore.getTranscript(chrom, nm)
+        if transcript is not None and transcript.exons:
+            boundList = [bound for exon in transcript.exons for bound in exon]
+            nmSpanDict.setdefault(chrom, list()).append((nm, min(boundList), max(boundList)))
+
+def getPreferedNm(chrom, pos):
+    # the last prefered nm (prefered nm file order) whose gtf span, first to last exon base, contains the position.
+    # table_maker picks its nm among the uta transcripts overlapping the variant, so both can differ near transcript
+    # ends or with overlapping prefered transcripts : table_maker reads the canonical scores of a record only when its
+    # nm is the prefered nm of the variant and computes them otherwise (cryptic and ESR scores do not depend on the nm)
+    preferedNm = "NA"
+    for nm, start, end in nmSpanDict.get(chrom, list()):
+        if start <= pos - 1 <= end:
+            preferedNm = nm
+    return preferedNm
+
+def setRecordValues(record, fieldList, valueList):
+    # the int values (maxentscan scores clamped to 0) are flagged to be read back as int
+    for field, value in zip(fieldList, valueList):
+        if value == "NA":
+            record[field] = numpy.nan
+        else:
+            record[field] = float(value)
+            if isinstance(value, (int, long)):
+                record['int_fields'] |= 1 << clinTools.SNV_TABLE_FIELDS.index(field)
+
+nmList = [nm for nm in preferedNmList if any(nm == span[0] for spanList in nmSpanDict.values() for span in spanList)]
+recordArray = numpy.zeros(sum([end - start for chrom, start, end in regionList]) * 3, dtype=clinTools.SNV_TABLE_DTYPE)
+offsetList = list()
+offset = 0
+for chrom, start, end in regionList:
+    offsetList.append(offset)
+    regionSeq = REF_FASTA.fetch(chrom, start, end).upper()
+    variantList = list()
+    for i, refBase in enumerate(regionSeq):
+        pos = start + i + 1
+        for altBase in clinTools.getSnvAltBases(refBase)[:3]:
+            variantList.append((chrom, pos, refBase, altBase))
+
+    esrScoreList = clinTools.getESRScores(variantList, esrScoreArray, REF_FASTA)
+
+    for (chrom, pos, refBase, altBase), esrScores in zip(variantList, esrScoreList):
+        record = recordArray[offset + (pos - 1 - start) * 3 + clinTools.getSnvAltBases(refBase).index(altBase)]
+        record['ref'] = refBase
+        record['nm'] = -1
+        for field in clinTools.SNV_TABLE_FIELDS:
+            record[field] = numpy.nan
+        if refBase not in 'ACGT':
+            continue
+
+        prefered_nm = getPreferedNm(chrom, pos)
+        if prefered_nm != "NA":
+            record['nm'] = nmList.index(prefered_nm)
+            mesScores = clinTools.getMesScores(chrom, pos, refBase, altBase, "NA", transcriptStore, REF_FASTA, prefered_nm, mesScriptDir)
+            setRecordValues(record, ['mes_ref', 'mes_alt', 'mes_delta'], mesScores)
+
+        # same fallback as table_maker when no window can be scored
+        try:
+            mesScores = clinTools.getMesSlidingWindow(chrom, refBase, altBase, pos, REF_FASTA, mesScriptDir)
+        except ValueError:
+            mesScores = 0, 0, 0, 0
+        setRecordValues(record, ['mes_cryptic_acceptor_wt', 'mes_cryptic_acceptor_mut', 'mes_cryptic_donor_wt', 'mes_cryptic_donor_mut'], mesScores)
+
+        setRecordValues(record, ['esr_ref', 'esr_alt', 'esr_delta'], esrScores)
+
+    offset += (end - start) * 3
+
+numpy.save(outputPrefix + '.npy', recordArray)
+with open(outputPrefix + '.idx', 'w') as idxFile:
+    idxFile.write('\t'.join(['#nm'] + nmList) + '\n')
+    idxFile.write('#chrom\tstart\tend\toffset\n')
+    for (chrom, start, end), offset in zip(regionList, offsetList):
+        idxFile.write('\t'.join([chrom, str(start), str(end), str(offset)]) + '\n')
@@ -33,241 +33,266 @@
 # The fact that you are presently reading this means that you have had
 # knowledge of the CeCILL license and that you accept its terms.
 
-import optparse, sys, re, string, subprocess, tempfile, os
-
-
-def parsePileupLine(pileupLine):
-    chrom, pos, ref, depth, readBase, qual = pileupLine.rstrip('\n').split('\t')
-
-    ref = ref.upper()
-
-    depth = 0
-
-    countA = 0
-    countT = 0
-    countG = 0
-    countC = 0
-    countN = 0
-    counta = 0
-    countt = 0
-    countg = 0
-    countc = 0
-    countn = 0
-    insCountDict = dict()
-    insString = '0'
-    delCountDict = dict()
-    delString = '0'
-
-    # clean read base
-    readBase = re.sub('\^.', '', readBase)
-    readBase = re.sub('\$', '', readBase)
-
-    # find insertion and deletion
-    insMatch = re.findall('(\+[ATCGNatcgn0-9]+)', readBase)
-    delMatch = re.findall('(\-[ATCGNatcgn0-9]+)', readBase)
-
-    # handle insertion
-    for ins in insMatch:
-        depth += 1
-        insLen = int(re.findall('\+([0-9]+)', ins)[0])
-        insSeq = re.findall('\+' + str(insLen) + '([ATCGNatcgn]{' + str(insLen) + '})', ins)[0]
-        # clean readbase
-        readBase = re.sub('\+' + str(insLen) + insSeq, '', readBase)
-
-        # add count to count dict
-        if insSeq in insCountDict.keys():
-            insCountDict[insSeq][0] += 1
-        elif insSeq.upper() in insCountDict.keys():
-            insCountDict[insSeq.upper()][1] += 1
-        elif insSeq.isupper():
-            insCountDict[insSeq] = [1, 0]
-        else:
-            insCountDict[insSeq.upper()] = [0, 1]
-
-    # handle deletion
-    for deletion in delMatch:
-        depth += 1
-        delLen = int(re.findall('\-([0-9]+)', deletion)[0])
-        delSeq = re.findall('\-' + str(delLen) + '([ATCGNatcgn]{' + str(delLen) + '})', deletion)[0]
-        # clean readbase
-        readBase = re.sub('\-' + str(delLen) + delSeq, '', readBase)
-
-        # add count to count dict
-        if delSeq in delCountDict.keys():
-            delCountDict[delSeq][0] += 1
-        elif delSeq.upper() in delCountDict.keys():
-            delCountDict[delSeq.upper()][1] += 1
-        elif delSeq.isupper():
-            delCountDict[delSeq] = [1, 0]
-        else:
-            delCountDict[delSeq.upper()] = [0, 1]
-
-    # count snv
-    for base in readBase:
-        depth += 1
-        # get proper base for reference supporting reads
-        if base == '.':
-            base = ref
-        elif base == ',':
-            base = ref.lower()
-
-        if base == 'A':
-            countA += 1
-        elif base == 'a':
-            counta += 1
-        elif base == 'T':
-            countT += 1
-        elif base == 't':
-            countt += 1
-        elif base == 'C':
-            countC += 1
-        elif base == 'c':
-            countc += 1
-        elif base == 'G':
-            countG += 1
-        elif base == 'g':
-            countg += 1
-        elif base == 'N' or base == 'n':
-            countN += 1
-        elif base == '*':
-            if base in delCountDict.keys():
-                delCountDict[base][0] += 1
+import optparse, sys, re, string, subprocess, tempfile, os, shutil, multiprocessing, zipfile, io, cPickle, gzip
+# numpy and pysam are imported in the functions of the options which need them (npz output, -a, tabix pileups, -j
+# with bam files), so that reports of pileups and of bams through samtools mpileup work without them
+import clinTools
+
+
+# number of rows of each row group of the columnar outputs
+ROW_GROUP_SIZE = 50000
+
+
+class TsvRowWriter(object):
+
+    """Write report rows as tabulated lines"""
+
+    def __init__(self, outFile):
+        self.outFile = outFile
+
+    def writeRow(self, outLineList):
+        self.outFile.write('\t'.join([str(elt) for elt in outLineList]) + '\n')
+
+    def close(self):
+        self.outFile.flush()
+
+
+class ColumnarRowWriter(object):
+
+    """Write report rows as typed columns, in row groups of ROW_GROUP_SIZE rows written as soon as they are full
+
+    Counts, position and depth are integers, ratios are floats and the other columns are strings (as printed in the
+    tabulated output).
+
+    :param fileName: the output file
+    :param outputFormat: "parquet" (needs pyarrow) or "npz" (one array per column and row group, named
+        column_groupindex, and the column order in the "columns" array, stored uncompressed so each array can be
+        memory-mapped at its offset in the file)
+    :param headerLineList: the column names
+    """
+
+    def __init__(self, fileName, outputFormat, headerLineList):
+        self.headerLineList = headerLineList
+        self.outputFormat = outputFormat
+        self.columnTypeList = list()
+        for column in headerLineList:
+            if column.endswith('_ratio'):
+                self.columnTypeList.append(float)
+            elif column in ('barcode', 'chromosome', 'reference', 'Ins', 'Del', 'Name'):
+                self.columnTypeList.append(str)
             else:
-                delCountDict[base] = [1]
+                self.columnTypeList.append(int)
+        self.columnList = [list() for column in headerLineList]
+        self.nGroup = 0
+
+        if outputFormat == 'parquet':
+            try:
+                import pyarrow, pyarrow.parquet
+            except ImportError:
+                raise Exception("pyarrow python module is needed for parquet output")
+            self.pyarrow = pyarrow
+            arrowTypeDict = {float: pyarrow.float64(), int: pyarrow.int64(), str: pyarrow.string()}
+            self.schema = pyarrow.schema([(column, arrowTypeDict[columnType])
+                for column, columnType in zip(headerLineList, self.columnTypeList)])
+            self.writer = pyarrow.parquet.ParquetWriter(fileName, self.schema)
+        elif outputFormat == 'npz':
+            import numpy
+            self.numpy = numpy
+            self.writer = zipfile.ZipFile(fileName, 'w', zipfile.ZIP_STORED, allowZip64=True)
+            self.writeNpy('columns', self.numpy.array(headerLineList))
+        else:
+            raise Exception("invalid output format : " + outputFormat)
+
+    def writeNpy(self, name, array):
+        npyFile = io.BytesIO()
+        self.numpy.lib.format.write_array(npyFile, array)
+        self.writer.writestr(name + '.npy', npyFile.getvalue())
+
+    def writeRow(self, outLineList):
+        for valueList, columnType, value in zip(self.columnList, self.columnTypeList, outLineList):
+            valueList.append(columnType(value))
+        if len(self.columnList[0]) >= ROW_GROUP_SIZE:
+            self.writeRowGroup()
+
+    def writeRowGroup(self):
+        if len(self.columnList[0]) == 0:
+            return
+        if self.outputFormat == 'parquet':
+            arrayList = [self.pyarrow.array(valueList, type=field.type) for valueList, field in zip(self.columnList, self.schema)]
+            self.writer.write_table(self.pyarrow.Table.from_arrays(arrayList, schema=self.schema))
         else:
-            raise Exception("invalid base in read base field : " + base + '\nline :' + line)
+            for column, columnType, valueList in zip(self.headerLineList, self.columnTypeList, self.columnList):
+                self.writeNpy('{0}_{1:06d}'.format(column, self.nGroup), self.numpy.array(valueList, dtype=columnType))
+        self.nGroup += 1
+        self.columnList = [list() for column in self.headerLineList]
 
-    pileupDict = {
-        'chrom': chrom, 'pos': pos,
-        'depth': depth, 'ref': ref,
-        'A': [countA, counta],
-        'T': [countT, countt],
-        'C': [countC, countc],
-        'G': [countG, countg],
-        'countN': countN,
-        'ins': insCountDict, 'del': delCountDict
-    }
-    return pileupDict
+    def close(self):
+        self.writeRowGroup()
+        self.writer.close()
 
 
-parser = optparse.OptionParser(usage="%prog [options] conf_file ref_genome_file",
-    description="Generate a report of number of reads supporting each base at given regions. This script work on mpileup and bam files depending on files extensions in conf file (.pileup or .bam). If you use bam files, it is highly recommended to use a bed file with the -b option. The configuration must contain \"sample_name\\tpath_to_file(.pileup or .bam)\" in each line. Output positions are 1-based")
-parser.add_option(
-    "-r", "--ratio", default=False, action="store_true",
-    help="If set allelic ratio are reported in output"
-)
-parser.add_option(
-    "-R", "--reference", default=None, type=str,
-    help="Reference fasta file (mandatory with bam files)"
-)
-parser.add_option(
-    "-n", "--names", default=False, action="store_true",
-    help="Print names from bed in output"
-)
-parser.add_option(
-    "-b", "--bed_file", default=None, type=str,
-    help="Bed file to use for intersection (0-based positions)"
-)
-parser.add_option(
-    "-q", "--mapQ", default=0,
-    help="-q option for mpileup. mapQ threshold (default : 0). This option is useful only if you use bam files as input."
-)
-parser.add_option(
-    "-Q", "--BAQ", default=0,
-    help="-Q option for mpileup. base quality threshold (default : 0). This option is useful only if you use bam files as input."
-)
-parser.add_option(
-    "-s", "--keep-strand", default=False, action="store_true",
-    help="If set base counts for both strands are separated"
-)
-(options, args) = parser.parse_args()
+class TaskRowWriter(object):
 
-if len(args) != 1:
-    parser.print_help()
-    exit(1)
+    """Write the report rows of a parallel task as pickled row groups, read back with readTaskRows"""
 
+    def __init__(self, outFile):
+        self.outFile = outFile
+        self.rowList = list()
 
-confFile = open(args[0], 'r')
+    def writeRow(self, outLineList):
+        self.rowList.append(outLineList)
+        if len(self.rowList) >= ROW_GROUP_SIZE:
+            self.close()
 
-bedFileName = options.bed_file
+    def close(self):
+        if len(self.rowList) != 0:
+            cPickle.dump(self.rowList, self.outFile, cPickle.HIGHEST_PROTOCOL)
+            self.rowList = list()
 
-stderrFile = sys.stderr
 
-if options.keep_strand:
-    if options.ratio:
-        headerLineList = [
-            "barcode", "chromosome", "position", 'reference', 'depth',
-            'A+', 'A+_ratio', 'A-', 'A-_ratio', 'T+', 'T+_ratio', 'T-', 'T-_ratio',
-            'C+', 'C+_ratio', 'C-', 'C-_ratio', 'G+', 'G+_ratio', 'G-', 'G-_ratio',
-            'N', 'N_ratio', 'Ins', 'Del'
-        ]
-    else:
-        headerLineList = [
-            "barcode", "chromosome", "position", 'reference', 'depth',
-            'A+', 'A-', 'T+', 'T-', 'C+', 'C-', 'G+', 'G-', 'N', 'Ins', 'Del'
-        ]
-else:
-    if options.ratio:
-        headerLineList = [
-            "barcode", "chromosome", "position", 'reference', 'depth',
-            'A', 'A_ratio', 'T', 'T_ratio', 'C', 'C_ratio', 'G', 'G_ratio',
-            'N', 'N_ratio', 'Ins', 'Del'
-        ]
-    else:
-        headerLineList = [
-            "barcode", "chromosome", "position", 'reference', 'depth',
-            'A', 'T', 'C', 'G', 'N', 'Ins', 'Del'
-        ]
+def readTaskRows(taskFile):
 
-if bedFileName is not None:
-    if options.names:
-        headerLineList.append('Name')
-        bedFile = open(bedFileName, 'r')
-        bedDict = dict()
-        chromList = list()
-        for line in bedFile:
-            lineList = line.rstrip().split('\t')
-            if lineList[0] in bedDict.keys():
-                bedDict[lineList[0]].append(
-                    {'start': str(int(lineList[1]) + 1),
-                     'end': str(int(lineList[2]) + 1),
-                     'name': lineList[3]}
-                )
-            else:
-                bedDict[lineList[0]] = [
-                    {'start': str(int(lineList[1]) + 1),
-                     'end': str(int(lineList[2]) + 1),
-                     'name': lineList[3]}
-                ]
-                chromList.append(lineList[0])
-    else:
-        bedFile = open(bedFileName, 'r')
-        bedDict = dict()
-        chromList = list()
-        for line in bedFile:
-            lineList = line.rstrip().split('\t')
-            # convert start position to 1-based but not end to have the same behaviour as samtools mpileup -l
-            if lineList[0] in bedDict.keys():
-                bedDict[lineList[0]].append(
-                    {'start': str(int(lineList[1]) + 1), 'end': str(int(lineList[2]))}
-                )
+    """Iterate over the rows written by a TaskRowWriter"""
+
+    while True:
+        try:
+            rowList = cPickle.load(taskFile)
+        except EOFError:
+            return
+        for outLineList in rowList:
+            yield outLineList
+
+
+def openPileup(fileName):
+
+    """Open a pileup file for reading, plain or compressed (.gz)"""
+
+    if fileName.endswith('.gz'):
+        return gzip.open(fileName, 'r')
+
+    return open(fileName, 'r')
+
+
+def getTabixPileupLines(fileName):
+
+    """Iterate over the lines of a tabix indexed pileup inside the bed regions, in the order of the pileup file
+    (same lines as the intersection of the whole pileup with the bed)"""
+
+    import pysam
+    pileupTabix = pysam.TabixFile(fileName)
+    for chrom in pileupTabix.contigs:
+        for start, end in bedIndex.getMergedRegions(chrom):
+            for linePileup in pileupTabix.fetch(chrom, start - 1, end):
+                yield linePileup + '\n'
+    pileupTabix.close()
+
+
+def writeArrayCountReport(barcode, fileName, rowWriter):
+
+    """Write the report rows of a bam sample to rowWriter from the count arrays of each bed region
+    (same output as the mpileup of each region)"""
+
+    import numpy, pysam
+    BamFile = pysam.AlignmentFile(fileName, 'rb')
+    refFasta = pysam.FastaFile(options.reference)
+    # output order of the bases (A, T, C, G) in the count arrays
+    baseIndexList = [clinTools.COUNT_ARRAY_BASES.index(base) for base in 'ATCG']
+    nIndex = clinTools.COUNT_ARRAY_BASES.index('N')
+
+    delStore = None
+    delChrom = None
+    for chrom in chromList:
+        if chrom not in BamFile.references:
+            stderrFile.write("chromosome " + chrom + " is not in " + fileName + "\n")
+            continue
+
+        for region in bedDict[chrom]:
+            regionDict = clinTools.getRegionCountArrays(chrom, int(region['start']), int(region['end']), BamFile, refFasta, options.mapQ, options.BAQ)
+            countArray = regionDict['counts']
+            depthArray = regionDict['depth']
+
+            # counts of A, T, C, G (both strands separated or summed) then N (summed)
+            if options.keep_strand:
+                baseCountArray = countArray[:, baseIndexList, :].reshape(len(depthArray), 2 * len(baseIndexList))
             else:
-                bedDict[lineList[0]] = [
-                    {'start': str(int(lineList[1]) + 1), 'end': str(int(lineList[2]))}
-                ]
-                chromList.append(lineList[0])
+                baseCountArray = countArray[:, baseIndexList, :].sum(axis=2)
+            valueArray = numpy.concatenate([baseCountArray, countArray[:, nIndex, :].sum(axis=1)[:, None]], axis=1)
+
+            if options.ratio:
+                # same operations as "%.2f" % ((float(count)/float(depth))*100.0) on each count, 0 if depth is 0
+                with numpy.errstate(divide='ignore', invalid='ignore'):
+                    ratioArray = (valueArray / depthArray[:, None].astype(float)) * 100.0
+                ratioArray[depthArray == 0] = 0
+                ratioStringArray = numpy.char.mod('%.2f', ratioArray)
+
+            for i in numpy.flatnonzero(regionDict['covered']):
+                pos = regionDict['start'] + i
+                if chrom != delChrom:
+                    delStore = None
+                    delChrom = chrom
+
+                outLineList = [barcode, chrom, pos, regionDict['ref'][i], depthArray[i]]
+                if options.ratio:
+                    for value, ratioString in zip(valueArray[i], ratioStringArray[i]):
+                        outLineList.extend([value, ratioString])
+                else:
+                    outLineList.extend(valueArray[i])
+
+                insCountDict = regionDict['ins'].get(i, {})
+                delCountDict = regionDict['del'].get(i, {})
+                if options.keep_strand:
+                    insString = ';'.join(["{seq}:{countFw},{countRv}".format(seq=key, countFw=value[0], countRv=value[1])
+                        for key, value in insCountDict.items()]) or None
+                    delString = "*:{count}".format(count=regionDict['deleted'][i]) if regionDict['deleted'][i] else None
+                    storeString = ';'.join(["{seq}:{countFw},{countRv}".format(seq=key, countFw=value[0], countRv=value[1])
+                        for key, value in delCountDict.items()]) or None
+                    if delStore is not None:
+                        delString = delStore if delString is None else delString + ';' + delStore
+                else:
+                    insString = ';'.join(["{seq}:{count}".format(seq=key, count=sum(value))
+                        for key, value in insCountDict.items()]) or 0
+                    delString = "*:{count}".format(count=regionDict['deleted'][i]) if regionDict['deleted'][i] else "0"
+                    storeString = ';'.join(["{seq}:{count}".format(seq=key, count=sum(value))
+                        for key, value in delCountDict.items()]) or "0"
+                    if delStore is not None:
+                        delString = delStore if delString == "0" else delString + ';' + delStore
+                outLineList.extend([insString, delString])
+                delStore = storeString
+
+                if options.names:
+                    outLineList.append(','.join(bedIndex.getNames(chrom, pos)))
 
+                rowWriter.writeRow(outLineList)
 
-# print header
-print '\t'.join(headerLineList)
 
-tempFileName = None
+def writeSampleReport(barcode, fileName, contig, rowWriter):
 
-for confLine in confFile:
-    try:
-        barcode, fileName = confLine.rstrip().split('\t')
+    """Write the report rows of a sample to rowWriter, only the rows of contig if it is not None"""
+
+    if re.search('.bam$', fileName) and options.count_arrays:
+        if options.reference is None or bedFileName is None:
+            raise Exception('A reference fasta and a bed file are needed to count bams in arrays')
+        writeArrayCountReport(barcode, fileName, rowWriter)
+        return
 
-        if re.search('.bam$', fileName):
+    tempFileName = None
+    pileupProcess = None
+    try:
+        if re.search('.bam$', fileName) and options.single_pileup:
+            if options.reference is None:
+                raise Exception('Missing reference fasta in option to perform pileup on bams')
+            cmdList = [
+                "samtools", "mpileup", "-AB", "-f", options.reference, "-q",
+                str(options.mapQ), "-Q", str(options.BAQ), "-d", "1000000"
+            ]
+            if bedFileName is not None:
+                cmdList.extend(["-l", bedFileName])
+            elif contig is not None:
+                cmdList.extend(["-r", contig])
+            cmdList.append(fileName)
+            pileupProcess = subprocess.Popen(cmdList, stdout=subprocess.PIPE, stderr=stderrFile)
+            pileupFile = pileupProcess.stdout
+        elif re.search('.bam$', fileName):
             if options.reference is None:
                 raise('Missing reference fasta in option to perform pileup on bams')
             tempPileupFile = tempfile.NamedTemporaryFile(mode="a+b", delete=False)
@@ -288,6 +313,8 @@ for confLine in confFile:
                         sp = subprocess.Popen(cmd, stdout=tempPileupFile, stderr=stderrFile, shell=True)
                         sp.wait()
             else:
+                if contig is not None:
+                    cmdList.append("-r " + contig)
                 cmdList.append(fileName)
                 cmd = ' '.join(cmdList)
                 sp = subprocess.Popen(cmd, stdout=tempPileupFile, stderr=stderrFile, shell=True)
@@ -295,35 +322,40 @@ for confLine in confFile:
 
             tempPileupFile.close()
             pileupFile = open(tempPileupFile.name, 'r')
+        elif re.search('.pileup.gz$', fileName) and bedFileName is not None and os.path.exists(fileName + '.tbi'):
+            # bgzip pileup indexed with tabix (clinTools.indexPileup) : seek the bed regions instead of reading it all
+            pileupFile = getTabixPileupLines(fileName)
         elif re.search('.pileup', fileName):
             if bedFileName is not None:
                 tempPileupFile = tempfile.NamedTemporaryFile(mode='w', delete=False)
                 tempFileName = tempPileupFile.name
                 # intersect bed with pileup
-                pileupFile = open(fileName, 'r')
+                pileupFile = openPileup(fileName)
                 for linePileup in pileupFile:
                     chrom, pos = linePileup.rstrip().split('\t')[:2]
-                    if chrom in chromList:
-                        for region in bedDict[chrom]:
-                            if int(region['start']) <= int(pos) <= int(region['end']):
-                                tempPileupFile.write(linePileup)
-                                break
+                    if bedIndex.overlaps(chrom, int(pos)):
+                        tempPileupFile.write(linePileup)
 
                 tempPileupFile.close()
                 pileupFile = open(tempFileName, 'r')
             else:
-                pileupFile = open(fileName, 'r')
+                pileupFile = openPileup(fileName)
         else:
-            raise Exception("invalid file extension. usable extension are .pileup and .bam")
+            raise Exception("invalid file extension. usable extension are .pileup, .pileup.gz and .bam")
 
         # create storing variable for dels --> useful to report deletions at the right position
         delStore = None
+        delChrom = None
 
         for line in pileupFile:
-            # pileupDict = clinTools.parsePileupLine(line)
-            pileupDict = parsePileupLine(line)
+            pileupDict = clinTools.parsePileupLine(line)
             pos = pileupDict['pos']
 
+            # a deletion is reported at the next position of the same chromosome
+            if pileupDict['chrom'] != delChrom:
+                delStore = None
+                delChrom = pileupDict['chrom']
+
             outLineList = [barcode, pileupDict['chrom'], pos, pileupDict['ref'], str(pileupDict['depth'])]
 
             if options.keep_strand:
@@ -472,14 +504,227 @@ for confLine in confFile:
 
             if bedFileName is not None:
                 if options.names:
-                    namesList = list()
-                    for elt in bedDict[pileupDict['chrom']]:
-                        if int(elt['start']) <= int(pos) <= int(elt['end']):
-                            namesList.append(elt['name'])
+                    outLineList.append(','.join(bedIndex.getNames(pileupDict['chrom'], int(pos))))
 
-                    outLineList.append(','.join(namesList))
+            rowWriter.writeRow(outLineList)
 
-            print '\t'.join([str(elt) for elt in outLineList])
+        if pileupProcess is not None and pileupProcess.wait() != 0:
+            raise Exception("samtools mpileup failed on " + fileName)
     finally:
         if tempFileName:
             os.remove(tempFileName)
+
+
+def runTask(task):
+
+    """Write the report of a task (index, barcode, fileName, contig) in the task directory and return the file name"""
+
+    taskIndex, barcode, fileName, contig = task
+    outFileName = os.path.join(taskDir, str(taskIndex))
+    with open(outFileName, 'wb') as outFile:
+        # rows of columnar outputs are kept typed
+        if options.output_format == 'tsv':
+            taskRowWriter = TsvRowWriter(outFile)
+        else:
+            taskRowWriter = TaskRowWriter(outFile)
+        writeSampleReport(barcode, fileName, contig, taskRowWriter)
+        taskRowWriter.close()
+
+    return outFileName
+
+
+def getBamContigs(fileName):
+
+    """Contig names of a bam header, in header order"""
+
+    import pysam
+    BamFile = pysam.AlignmentFile(fileName, 'rb')
+    contigList = list(BamFile.references)
+    BamFile.close()
+
+    return contigList
+
+
+parser = optparse.OptionParser(usage="%prog [options] conf_file ref_genome_file",
+    description="Generate a report of number of reads supporting each base at given regions. This script work on mpileup and bam files depending on files extensions in conf file (.pileup or .bam). If you use bam files, it is highly recommended to use a bed file with the -b option. The configuration must contain \"sample_name\\tpath_to_file(.pileup or .bam)\" in each line. Output positions are 1-based")
+parser.add_option(
+    "-r", "--ratio", default=False, action="store_true",
+    help="If set allelic ratio are reported in output"
+)
+parser.add_option(
+    "-R", "--reference", default=None, type=str,
+    help="Reference fasta file (mandatory with bam files)"
+)
+parser.add_option(
+    "-n", "--names", default=False, action="store_true",
+    help="Print names from bed in output"
+)
+parser.add_option(
+    "-b", "--bed_file", default=None, type=str,
+    help="Bed file to use for intersection (0-based positions)"
+)
+parser.add_option(
+    "-q", "--mapQ", default=0, type=int,
+    help="-q option for mpileup. mapQ threshold (default : 0). This option is useful only if you use bam files as input."
+)
+parser.add_option(
+    "-Q", "--BAQ", default=0, type=int,
+    help="-Q option for mpileup. base quality threshold (default : 0). This option is useful only if you use bam files as input."
+)
+parser.add_option(
+    "-s", "--keep-strand", default=False, action="store_true",
+    help="If set base counts for both strands are separated"
+)
+parser.add_option(
+    "-l", "--single-pileup", default=False, action="store_true",
+    help="With bam files, run one samtools mpileup per bam on all the regions of the bed file (mpileup -l) and parse its output as it is produced, instead of one mpileup per region written to a temporary file. Positions of overlapping regions are then reported once, in bam order."
+)
+parser.add_option(
+    "-a", "--count-arrays", default=False, action="store_true",
+    help="With bam files and a bed file, count the bases of each region in arrays with pysam instead of running samtools mpileup. The output is the same as without this option."
+)
+parser.add_option(
+    "-j", "--jobs", default=1, type=int,
+    help="Number of processes. Samples are processed in parallel, and the contigs of bam files if no bed file is given. The output is the same as with one process (default : 1)"
+)
+parser.add_option(
+    "-f", "--output-format", default="tsv", type="choice", choices=["tsv", "parquet", "npz"],
+    help="Output format : tsv, parquet (needs pyarrow) or npz. parquet and npz files hold the same columns as the tsv with integer counts and float ratios, written in row groups of " + str(ROW_GROUP_SIZE) + " rows (default : tsv)"
+)
+parser.add_option(
+    "-o", "--output", default=None, type=str,
+    help="Output file (default : standard output, mandatory with parquet and npz formats)"
+)
+(options, args) = parser.parse_args()
+
+if len(args) != 1:
+    parser.print_help()
+    exit(1)
+
+if options.output_format != 'tsv' and options.output is None:
+    parser.error("an output file (-o) is needed with the " + options.output_format + " format")
+
+
+confFile = open(args[0], 'r')
+
+bedFileName = options.bed_file
+
+stderrFile = sys.stderr
+
+if options.keep_strand:
+    if options.ratio:
+        headerLineList = [
+            "barcode", "chromosome", "position", 'reference', 'depth',
+            'A+', 'A+_ratio', 'A-', 'A-_ratio', 'T+', 'T+_ratio', 'T-', 'T-_ratio',
+            'C+', 'C+_ratio', 'C-', 'C-_ratio', 'G+', 'G+_ratio', 'G-', 'G-_ratio',
+            'N', 'N_ratio', 'Ins', 'Del'
+        ]
+    else:
+        headerLineList = [
+            "barcode", "chromosome", "position", 'reference', 'depth',
+            'A+', 'A-', 'T+', 'T-', 'C+', 'C-', 'G+', 'G-', 'N', 'Ins', 'Del'
+        ]
+else:
+    if options.ratio:
+        headerLineList = [
+            "barcode", "chromosome", "position", 'reference', 'depth',
+            'A', 'A_ratio', 'T', 'T_ratio', 'C', 'C_ratio', 'G', 'G_ratio',
+            'N', 'N_ratio', 'Ins', 'Del'
+        ]
+    else:
+        headerLineList = [
+            "barcode", "chromosome", "position", 'reference', 'depth',
+            'A', 'T', 'C', 'G', 'N', 'Ins', 'Del'
+        ]
+
+if bedFileName is not None:
+    if options.names:
+        headerLineList.append('Name')
+        bedFile = open(bedFileName, 'r')
+        bedDict = dict()
+        chromList = list()
+        for line in bedFile:
+            lineList = line.rstrip().split('\t')
+            if lineList[0] in bedDict.keys():
+                bedDict[lineList[0]].append(
+                    {'start': str(int(lineList[1]) + 1),
+                     'end': str(int(lineList[2]) + 1),
+                     'name': lineList[3]}
+                )
+            else:
+                bedDict[lineList[0]] = [
+                    {'start': str(int(lineList[1]) + 1),
+                     'end': str(int(lineList[2]) + 1),
+                     'name': lineList[3]}
+                ]
+                chromList.append(lineList[0])
+    else:
+        bedFile = open(bedFileName, 'r')
+        bedDict = dict()
+        chromList = list()
+        for line in bedFile:
+            lineList = line.rstrip().split('\t')
+            # convert start position to 1-based but not end to have the same behaviour as samtools mpileup -l
+            if lineList[0] in bedDict.keys():
+                bedDict[lineList[0]].append(
+                    {'start': str(int(lineList[1]) + 1), 'end': str(int(lineList[2]))}
+                )
+            else:
+                bedDict[lineList[0]] = [
+                    {'start': str(int(lineList[1]) + 1), 'end': str(int(lineList[2]))}
+                ]
+                chromList.append(lineList[0])
+
+    # integer index of the regions for the pileup intersection and the names
+    bedIndex = clinTools.BedIndex([(chrom, int(region['start']), int(region['end']), region.get('name'))
+        for chrom in chromList for region in bedDict[chrom]])
+
+
+# print header
+if options.output_format == 'tsv':
+    if options.output is None:
+        outFile = sys.stdout
+    else:
+        outFile = open(options.output, 'w')
+    outFile.write('\t'.join(headerLineList) + '\n')
+    rowWriter = TsvRowWriter(outFile)
+else:
+    rowWriter = ColumnarRowWriter(options.output, options.output_format, headerLineList)
+
+# one task per sample, or per contig for whole bam runs in parallel
+taskList = list()
+for confLine in confFile:
+    barcode, fileName = confLine.rstrip().split('\t')
+    if options.jobs > 1 and bedFileName is None and re.search('.bam$', fileName):
+        for contig in getBamContigs(fileName):
+            taskList.append((len(taskList), barcode, fileName, contig))
+    else:
+        taskList.append((len(taskList), barcode, fileName, None))
+
+if options.jobs > 1:
+    taskDir = tempfile.mkdtemp()
+    # the forked processes must not write the header again when they flush their copy of the buffer
+    if options.output_format == 'tsv':
+        outFile.flush()
+    pool = multiprocessing.Pool(options.jobs)
+    try:
+        # imap gives the reports in task order, so the output is the same as with one job
+        for outFileName in pool.imap(runTask, taskList):
+            with open(outFileName, 'rb') as taskFile:
+                if options.output_format == 'tsv':
+                    shutil.copyfileobj(taskFile, outFile)
+                else:
+                    for outLineList in readTaskRows(taskFile):
+                        rowWriter.writeRow(outLineList)
+            os.remove(outFileName)
+        pool.close()
+    finally:
+        pool.terminate()
+        shutil.rmtree(taskDir)
+else:
+    for taskIndex, barcode, fileName, contig in taskList:
+        writeSampleReport(barcode, fileName, contig, rowWriter)
+
+rowWriter.close()
+if options.output_format == 'tsv' and options.output is not None:
+    outFile.close()
@@ -33,9 +33,13 @@
 # The fact that you are presently reading this means that you have had
 # knowledge of the CeCILL license and that you accept its terms.
 
-import os, tempfile, subprocess, sys, re, string
-import hgvs.variantmapper
+import os, tempfile, subprocess, sys, re, string, hashlib, collections, json, sqlite3, bisect, random, array, cPickle, gzip
 import logging
+try:
+    import numpy
+except ImportError:
+    # check_variants.py parses pileups without numpy, the array, maxentscan and snv table functions need it
+    numpy = None
 
 STDERR_FILE = sys.stderr
 TRANSLATION_TAB = string.maketrans('atcgATCG', 'tagcTAGC')
@@ -47,73 +51,526 @@ def checkSamtoolsVersion(version):
     if match[0] != version:
         logging.warning("The samtools version in your environnement is {0}, this tool was tested with samtools version {1}\nTo avoid errors you may consider updating your PATH environnement variable or update your samtools version".format(match[0], version))
 
-def parseChrGtf(gtfFile):
+class PersistentCache(object):
 
-    """Parse a gtf file in dict
+    """Two tier cache: an in-memory LRU dict and an optional SQLite file shared across runs
 
-    :param gtfFile: a gtf file path
+    Keys are tuples of str/int, values are json serializable tuples.
+    When the version stored in the SQLite file differs from the given version the file is emptied.
+
+    :param dbFileName: SQLite file path, None to keep only the in-memory tier
+    :type dbFileName: str
+    :param version: version of the cached data (ex : checksum of the models used to compute it)
+    :type version: str
+    :param maxSize: maximum number of entries in memory
+    :type maxSize: int
+    """
+
+    def __init__(self, dbFileName=None, version='', maxSize=100000):
+        self.memDict = collections.OrderedDict()
+        self.maxSize = maxSize
+        self.memoryHits = 0
+        self.diskHits = 0
+        self.misses = 0
+        self.pendingWrites = 0
+        self.db = None
+
+        if dbFileName is not None:
+            self.db = sqlite3.connect(dbFileName, timeout=60)
+            self.db.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT)")
+            row = self.db.execute("SELECT value FROM meta WHERE name = 'version'").fetchone()
+            if row is None or row[0] != version:
+                self.db.execute("DELETE FROM cache")
+                self.db.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)", (version,))
+            self.db.commit()
+
+    def _addToMemory(self, key, value):
+        self.memDict[key] = value
+        if len(self.memDict) > self.maxSize:
+            self.memDict.popitem(last=False)
+
+    def get(self, key):
+
+        """Return the cached value of key or None"""
+
+        if key in self.memDict:
+            # move key at the end of the LRU order
+            value = self.memDict.pop(key)
+            self.memDict[key] = value
+            self.memoryHits += 1
+            return value
+
+        if self.db is not None:
+            row = self.db.execute("SELECT value FROM cache WHERE key = ?", ('\t'.join([str(elt) for elt in key]),)).fetchone()
+            if row is not None:
+                value = tuple(json.loads(row[0]))
+                self._addToMemory(key, value)
+                self.diskHits += 1
+                return value
+
+        self.misses += 1
+        return None
+
+    def set(self, key, value):
+
+        """Store value for key in both tiers"""
+
+        value = tuple(value)
+        self._addToMemory(key, value)
+        if self.db is not None:
+            self.db.execute("INSERT OR REPLACE INTO cache VALUES (?, ?)", ('\t'.join([str(elt) for elt in key]), json.dumps(value)))
+            self.pendingWrites += 1
+            if self.pendingWrites >= 1000:
+                self.db.commit()
+                self.pendingWrites = 0
+
+    def getStats(self):
+
+        """Return a string with hit and miss counters"""
+
+        return "memory hits: {0}, disk hits: {1}, misses: {2}".format(self.memoryHits, self.diskHits, self.misses)
+
+    def close(self):
+        if self.db is not None:
+            self.db.commit()
+            self.db.close()
+            self.db = None
+
+class DataProviderRow(list):
+
+    """Row of an hgvs data provider answer read from a CachedDataProvider, its values are read by position or by column
+    name as in the rows of the data provider
+
+    :param valueList: values of the row
+    :type valueList: list
+    :param keyIndexDict: column name -> position
+    :type keyIndexDict: dict
+    """
+
+    def __init__(self, valueList, keyIndexDict):
+        list.__init__(self, valueList)
+        self.keyIndexDict = keyIndexDict
+
+    def __getitem__(self, key):
+        if isinstance(key, basestring):
+            key = self.keyIndexDict[key]
+
+        return list.__getitem__(self, key)
+
+    def keys(self):
+        return sorted(self.keyIndexDict, key=self.keyIndexDict.get)
+
+    def get(self, key, default=None):
+        if key in self.keyIndexDict:
+            return self[key]
+
+        return default
+
+def encodeProviderValue(value):
+
+    """Encode an answer of an hgvs data provider in json serializable lists (see decodeProviderValue)
+
+    :raises TypeError: if the answer contains values which are not json serializable
+    """
+
+    if isinstance(value, str):
+        # json decodes all strings as unicode, str values are tagged to be decoded as str
+        return ['str', value]
+    if value is None or isinstance(value, (bool, int, long, float, basestring)):
+        return ['value', value]
+    if isinstance(value, dict):
+        return ['dict', [[encodeProviderValue(key), encodeProviderValue(item)] for key, item in value.items()]]
+    if isinstance(value, (list, tuple)) and hasattr(value, 'keys'):
+        # database row, with the position of each column (psycopg2 rows keep it in _index)
+        if hasattr(value, '_index'):
+            keyIndexList = value._index.items()
+        else:
+            keyIndexList = [(key, i) for i, key in enumerate(value.keys())]
+        return ['row', [[encodeProviderValue(key), i] for key, i in keyIndexList], [encodeProviderValue(item) for item in value]]
+    if isinstance(value, (list, tuple)):
+        return ['list', [encodeProviderValue(item) for item in value]]
+
+    raise TypeError('{0} can not be cached'.format(type(value)))
+
+def decodeProviderValue(encodedValue):
+
+    """Decode an answer of an hgvs data provider encoded with encodeProviderValue, rows are DataProviderRow and str and
+    unicode values keep their type"""
+
+    valueType = encodedValue[0]
+    if valueType == 'str':
+        # unicode when read back from json
+        if isinstance(encodedValue[1], unicode):
+            return encodedValue[1].encode('utf-8')
+        return encodedValue[1]
+    if valueType == 'value':
+        return encodedValue[1]
+    if valueType == 'dict':
+        return dict((decodeProviderValue(key), decodeProviderValue(item)) for key, item in encodedValue[1])
+    if valueType == 'row':
+        keyIndexDict = dict((decodeProviderValue(key), i) for key, i in encodedValue[1])
+        return DataProviderRow([decodeProviderValue(item) for item in encodedValue[2]], keyIndexDict)
+
+    return [decodeProviderValue(item) for item in encodedValue[1]]
+
+class CachedDataProvider(object):
+
+    """Caching wrapper of an hgvs data provider (ex : hgvs.dataproviders.uta), answers of the queries are kept in a
+    PersistentCache whose version is the encoding version, the database url without credentials (its schema name is
+    the uta release, ex : uta_20150704) and the schema version of the database. hgvs 0.3.7 reads data_version and
+    schema_version from the same meta key, so the data release is only identified by the url.
+
+    The wrapper is used in place of the data provider (also by the hgvs variant mappers). Queries of CACHED_METHODS with
+    positional arguments are cached, rows are returned as DataProviderRow. Other methods are those of the data provider.
+
+    :param hdp: the hgvs data provider
+    :param dbFileName: SQLite file path, None to keep only the in-memory tier
+    :type dbFileName: str
+    """
+
+    # queries of the hgvs 0.3.7 uta provider (get_tx_seq is called by c_to_p for every variant)
+    CACHED_METHODS = set([
+        'get_tx_for_region', 'get_tx_info', 'get_tx_exons', 'get_tx_identity_info', 'get_tx_mapping_options',
+        'get_tx_for_gene', 'get_gene_info', 'get_tx_seq', 'get_acs_for_protein_seq'
+    ])
+    # version of encodeProviderValue, SQLite files written with another encoding are emptied
+    ENCODING_VERSION = 2
+
+    def __init__(self, hdp, dbFileName=None):
+        self.hdp = hdp
+        url = hdp.url
+        dbUrl = '{0}://{1}{2}'.format(url.scheme, url.netloc.rpartition('@')[2], url.path)
+        self.cache = PersistentCache(dbFileName, ':'.join([str(self.ENCODING_VERSION), dbUrl, hdp.schema_version()]))
+
+    def __getattr__(self, name):
+        method = getattr(self.hdp, name)
+        if name not in self.CACHED_METHODS:
+            return method
+
+        def cachedMethod(*args, **kwargs):
+            if kwargs:
+                return method(*args, **kwargs)
+            key = (name,) + args
+            value = self.cache.get(key)
+            if value is None:
+                try:
+                    value = (encodeProviderValue(method(*args)),)
+                except TypeError as e:
+                    logging.warning("answer of {0} not cached ({1})".format(name, e))
+                    return method(*args)
+                self.cache.set(key, value)
+
+            return decodeProviderValue(value[0])
+
+        return cachedMethod
+
+    def getStats(self):
+
+        """Return a string with hit and miss counters"""
+
+        return self.cache.getStats()
+
+    def close(self):
+        self.cache.close()
+
+def getArrayState(obj):
+
+    """Pickle state of an object with its arrays as raw bytes, much faster to unpickle than their lists of values"""
+
+    arrayDict = dict()
+    valueDict = dict()
+    for name, value in obj.__dict__.items():
+        if isinstance(value, array.array):
+            arrayDict[name] = (value.typecode, value.tostring())
+        else:
+            valueDict[name] = value
+
+    return arrayDict, valueDict
+
+def setArrayState(obj, state):
+
+    """Restore the state of an object pickled with getArrayState"""
+
+    arrayDict, valueDict = state
+    obj.__dict__.update(valueDict)
+    for name, (typecode, data) in arrayDict.items():
+        valueArray = array.array(typecode)
+        valueArray.fromstring(data)
+        setattr(obj, name, valueArray)
+
+def sortExonBoundaries(exonList):
+
+    """Return the (boundary, exon index, side) of the exons of a transcript sorted by position, side being 0 for the
+    first base of the exon in the transcript order (acceptor side) and 1 for the last one (donor side)
+
+    :param exonList: list of exons [first base, last base] in the transcript order
+    :type exonList: list
+    """
+
+    return sorted((bound, exonIndex, side) for exonIndex, exon in enumerate(exonList) for side, bound in enumerate(exon))
+
+def findNearestBoundary(boundaryArray, exonIndexArray, sideArray, pos, lo, hi):
+
+    """Return (distance, exon index, side) of the boundary nearest to pos among the boundaries lo to hi (excluded) of
+    sorted boundary arrays (see sortExonBoundaries), the first exon in the transcript order (then the acceptor side)
+    when several boundaries are at the same distance, None if there is no boundary"""
+
+    if lo == hi:
+        return None
+    i = bisect.bisect_left(boundaryArray, pos, lo, hi)
+    if i == hi:
+        dist = pos - boundaryArray[i - 1]
+    elif i == lo:
+        dist = boundaryArray[lo] - pos
+    else:
+        dist = min(pos - boundaryArray[i - 1], boundaryArray[i] - pos)
+
+    # boundaries at this distance (several exons can share a position)
+    candidateList = list()
+    for bound in set([pos - dist, pos + dist]):
+        j = bisect.bisect_left(boundaryArray, bound, lo, hi)
+        while j < hi and boundaryArray[j] == bound:
+            candidateList.append((exonIndexArray[j], sideArray[j]))
+            j += 1
+    exonIndex, side = min(candidateList)
+
+    return dist, exonIndex, side
+
+class ExonBoundaryIndex(object):
+
+    """Sorted index of the exon boundaries of a transcript for nearest boundary queries in O(log n)
+
+    :param exonList: list of exons [first base, last base] in the transcript order
+    :type exonList: list
+    """
+
+    def __init__(self, exonList):
+        boundaryList = sortExonBoundaries(exonList)
+        self.boundaryArray = array.array('l', [bound for bound, exonIndex, side in boundaryList])
+        self.exonIndexArray = array.array('l', [exonIndex for bound, exonIndex, side in boundaryList])
+        self.sideArray = array.array('b', [side for bound, exonIndex, side in boundaryList])
+
+    def getNearestBoundary(self, pos):
+
+        """Return (distance, exon index, side) of the boundary nearest to pos (see findNearestBoundary)"""
+
+        return findNearestBoundary(self.boundaryArray, self.exonIndexArray, self.sideArray, pos, 0, len(self.boundaryArray))
+
+class Transcript(object):
+
+    """View of a transcript of a TranscriptStore, its values are read in the arrays of the store"""
+
+    __slots__ = ('store', 'index')
+
+    def __init__(self, store, index):
+        self.store = store
+        self.index = index
+
+    @property
+    def nm(self):
+        return self.store.nmList[self.index]
+
+    @property
+    def gene(self):
+        return self.store.geneList[self.index]
+
+    @property
+    def strand(self):
+        return '+' if self.store.strandArray[self.index] == 1 else '-'
+
+    @property
+    def exons(self):
+
+        """List of exons [first base, last base] in the transcript order"""
+
+        start = self.store.exonOffsetArray[self.index]
+        end = self.store.exonOffsetArray[self.index + 1]
+
+        return [[first, last] for first, last in zip(self.store.exonFirstArray[start:end], self.store.exonLastArray[start:end])]
+
+    def getExon(self, exonIndex):
+
+        """Return the exon [first base, last base] of index exonIndex in the transcript order"""
+
+        if not 0 <= exonIndex < self.store.exonOffsetArray[self.index + 1] - self.store.exonOffsetArray[self.index]:
+            raise IndexError('exon index out of range')
+        i = self.store.exonOffsetArray[self.index] + exonIndex
+
+        return [self.store.exonFirstArray[i], self.store.exonLastArray[i]]
+
+    @property
+    def startCodon(self):
+        return self.getCodon(0)
+
+    @property
+    def stopCodon(self):
+        return self.getCodon(1)
+
+    def getCodon(self, codonIndex):
+        i = 4 * self.index + 2 * codonIndex
+        if self.store.codonArray[i] == -1:
+            return list()
+
+        return [self.store.codonArray[i], self.store.codonArray[i + 1]]
+
+    def getNearestBoundary(self, pos):
+
+        """Return (distance, exon index, side) of the exon boundary nearest to pos (see findNearestBoundary)"""
+
+        return findNearestBoundary(self.store.boundaryArray, self.store.boundaryExonArray, self.store.boundarySideArray, pos,
+            2 * self.store.exonOffsetArray[self.index], 2 * self.store.exonOffsetArray[self.index + 1])
+
+class TranscriptStore(object):
+
+    """Transcript annotations of a gtf in contiguous arrays, read through Transcript views
+
+    Exons of transcript i are the items exonOffsetArray[i] to exonOffsetArray[i + 1] of the exon arrays, in the
+    transcript order, and their boundaries sorted by position (see sortExonBoundaries) are the items 2 * exonOffsetArray[i]
+    to 2 * exonOffsetArray[i + 1] of the boundary arrays. Coordinates are 0-based, in 32 bit arrays.
+
+    :param annotDict: dict chrom -> nm -> dict with 'gene', 'strand', 'exons' (list of [first base, last base] in the
+        transcript order), 'start_codon' and 'stop_codon' ([first base, last base] or empty list)
+    :type annotDict: dict
+    """
+
+    def __init__(self, annotDict):
+        # chrom -> nm -> index of the transcript
+        self.chromDict = dict()
+        self.nmList = list()
+        self.geneList = list()
+        self.strandArray = array.array('b')
+        # start codon then stop codon of each transcript, -1 if there is none
+        self.codonArray = array.array('i')
+        self.exonOffsetArray = array.array('i', [0])
+        self.exonFirstArray = array.array('i')
+        self.exonLastArray = array.array('i')
+        self.boundaryArray = array.array('i')
+        self.boundaryExonArray = array.array('i')
+        self.boundarySideArray = array.array('b')
+
+        for chrom in sorted(annotDict):
+            nmIndexDict = self.chromDict[chrom] = dict()
+            for nm in sorted(annotDict[chrom]):
+                rnaDict = annotDict[chrom][nm]
+                nmIndexDict[nm] = len(self.nmList)
+                self.nmList.append(nm)
+                self.geneList.append(rnaDict['gene'])
+                self.strandArray.append(1 if rnaDict['strand'] == '+' else -1)
+                for codon in (rnaDict['start_codon'], rnaDict['stop_codon']):
+                    self.codonArray.extend(codon if codon else [-1, -1])
+                for first, last in rnaDict['exons']:
+                    self.exonFirstArray.append(first)
+                    self.exonLastArray.append(last)
+                self.exonOffsetArray.append(len(self.exonFirstArray))
+                for bound, exonIndex, side in sortExonBoundaries(rnaDict['exons']):
+                    self.boundaryArray.append(bound)
+                    self.boundaryExonArray.append(exonIndex)
+                    self.boundarySideArray.append(side)
+
+    def __getstate__(self):
+        return getArrayState(self)
+
+    def __setstate__(self, state):
+        setArrayState(self, state)
+
+    def getChromosomes(self):
+
+        """Return the list of the chromosomes with transcripts"""
+
+        return list(self.chromDict.keys())
+
+    def getTranscript(self, chrom, nm):
+
+        """Return the Transcript of nm on chrom, None if it is not in the store"""
+
+        nmIndex = self.chromDict.get(chrom, {}).get(nm)
+        if nmIndex is None:
+            return None
+
+        return Transcript(self, nmIndex)
+
+def parseChrGtf(gtfFile, nmSet=None):
+
+    """Parse a gtf file in a transcript store
+
+    :param gtfFile: a gtf file path (plain or compressed .gz)
     :type gtfFile: str
-    :return annotDict: a dictionnary of transcripts annotations
-    :rtype: dict
+    :param nmSet: nm ids of the transcripts to keep, None to keep all the transcripts
+    :type nmSet: set
+    :return transcriptStore: the transcripts annotations
+    :rtype: TranscriptStore
     """
 
+    if gtfFile.endswith('.gz'):
+        in_handle = gzip.open(gtfFile, 'r')
+    else:
+        in_handle = open(gtfFile, 'r')
+    with in_handle:
+        return parseGtfLines(in_handle, nmSet)
+
+def parseGtfLines(lineIter, nmSet=None):
+
+    """Parse the lines of a gtf file in a transcript store (see parseChrGtf)"""
+
     nmPattern = re.compile(r"transcript_id \"(NM_[0-9]+[_dup.]*[1-9]*)\"")
     genePattern = re.compile(r"gene_id \"(.*?)\"")
     annotDict = dict()
     acceptedNames = ['start_codon', 'stop_codon', 'exon']
 
-    with open(gtfFile, 'r') as in_handle:
-        for line in in_handle:
-            line = line.split("\t")
-            chrom = line[0]
-            name = line[2]
-            # convert to 0-base index
-            start = int(line[3]) -1
-            end = int(line[4]) - 1
-            strand = line[6]
-
-            if name not in acceptedNames:
-                continue
-
-            # get nm id
-            nmMatch = nmPattern.search(line[8])
-            if nmMatch:
-                nm = nmMatch.group(1)
-            else:
-                continue
-
-            # get gene name
-            geneMatch = genePattern.search(line[8])
-            if geneMatch:
-                gene = geneMatch.group(1)
-            else:
-                continue
+    for line in lineIter:
+        line = line.split("\t")
+        chrom = line[0]
+        name = line[2]
+        # convert to 0-base index
+        start = int(line[3]) -1
+        end = int(line[4]) - 1
+        strand = line[6]
+
+        if name not in acceptedNames:
+            continue
+
+        # get nm id
+        nmMatch = nmPattern.search(line[8])
+        if nmMatch:
+            nm = nmMatch.group(1)
+        else:
+            continue
+        if nmSet is not None and nm not in nmSet:
+            continue
+
+        # get gene name
+        geneMatch = genePattern.search(line[8])
+        if geneMatch:
+            gene = geneMatch.group(1)
+        else:
+            continue
 
-            if chrom not in annotDict.keys():
-                annotDict[chrom] = dict()
-            
-            if nm not in annotDict[chrom].keys():
-                annotDict[chrom][nm] = {
-                    'start_codon' : list(),
-                    'stop_codon' : list(),
-                    'exons' : list(),
-                    'gene' : gene,
-                    'strand' : ""
-                }
-
-            rnaDict = annotDict[chrom][nm]
-
-            if name == 'start_codon':
-                rnaDict['start_codon'] = [int(start), int(end)]
-            elif name == 'stop_codon':
-                rnaDict['stop_codon'] = [int(start), int(end)]
-            elif name == 'exon':
-                rnaDict['exons'].append([int(start), int(end)])
-            
-            if rnaDict['strand'] == "":
-                rnaDict['strand'] = strand
-            elif rnaDict['strand'] != strand:
-                raise Exception("All features must be on the same strand. nm :" + nm + " line : " + str(line)) 
+        if chrom not in annotDict:
+            annotDict[chrom] = dict()
+        
+        if nm not in annotDict[chrom]:
+            annotDict[chrom][nm] = {
+                'start_codon' : list(),
+                'stop_codon' : list(),
+                'exons' : list(),
+                'gene' : gene,
+                'strand' : ""
+            }
+
+        rnaDict = annotDict[chrom][nm]
+
+        if name == 'start_codon':
+            rnaDict['start_codon'] = [int(start), int(end)]
+        elif name == 'stop_codon':
+            rnaDict['stop_codon'] = [int(start), int(end)]
+        elif name == 'exon':
+            rnaDict['exons'].append([int(start), int(end)])
+        
+        if rnaDict['strand'] == "":
+            rnaDict['strand'] = strand
+        elif rnaDict['strand'] != strand:
+            raise Exception("All features must be on the same strand. nm :" + nm + " line : " + str(line)) 
 
     for chromDict in annotDict.values():
         for rnaDict in chromDict.values():
@@ -133,143 +590,334 @@ def parseChrGtf(gtfFile):
             else:
                 raise Exception("invalid strand : " + rnaDict['strand'])
 
-    return annotDict
+    return TranscriptStore(annotDict)
+
+# version of the parsed annotation structure, compiled gtf caches of other versions are rebuilt
+GTF_CACHE_VERSION = 2
+
+def writeFileAtomically(fileName, writeFunction):
+
+    """Write a file with writeFunction(fileObject) in a temporary file of the same directory, then rename it
+
+    Concurrent processes never read a partial file and a failed write leaves no file.
+
+    :param fileName: path of the file
+    :type fileName: str
+    :param writeFunction: function writing the content in the binary file object it is given
+    :type writeFunction: function
+    """
+
+    tempFile = tempfile.NamedTemporaryFile(mode='wb', dir=os.path.dirname(fileName), suffix=os.path.splitext(fileName)[1], delete=False)
+    try:
+        writeFunction(tempFile)
+        tempFile.close()
+        os.rename(tempFile.name, fileName)
+    finally:
+        if os.path.exists(tempFile.name):
+            os.remove(tempFile.name)
+
+def getFileChecksum(fileName):
+
+    """md5 checksum of the real path, size and modification time of a file (the file is not read)"""
+
+    fileName = os.path.realpath(fileName)
+    fileStat = os.stat(fileName)
+
+    return hashlib.md5('\t'.join([fileName, str(fileStat.st_size), repr(fileStat.st_mtime)])).hexdigest()
+
+def compileChrGtf(gtfFile, nmSet=None):
+
+    """Write the parsed annotation of a gtf file (see parseChrGtf) in a binary cache next to the gtf
+
+    The cache is named after a checksum of the gtf path, size and modification time so it is rebuilt when the gtf
+    changes, and after a checksum of the kept nm ids (see writeFileAtomically).
+
+    :param gtfFile: a gtf file path
+    :type gtfFile: str
+    :param nmSet: nm ids of the transcripts to keep, None to keep all the transcripts
+    :type nmSet: set
+    :return cacheFileName: path of the cache
+    :rtype: str
+    """
+
+    gtfFile = os.path.realpath(gtfFile)
+    checksum = hashlib.md5(str(GTF_CACHE_VERSION) + '\t' + getFileChecksum(gtfFile)).hexdigest()
+    if nmSet is None:
+        nmChecksum = 'all'
+    else:
+        nmChecksum = hashlib.md5('\t'.join(sorted(nmSet))).hexdigest()
+    cacheFileName = gtfFile + '.annot_' + checksum + '_' + nmChecksum + '.pickle'
+    if not os.path.exists(cacheFileName):
+        transcriptStore = parseChrGtf(gtfFile, nmSet)
+        writeFileAtomically(cacheFileName, lambda cacheFile: cPickle.dump(transcriptStore, cacheFile, cPickle.HIGHEST_PROTOCOL))
+
+        # remove caches compiled from previous versions of the gtf (caches of other nm ids are kept)
+        cachePattern = re.compile(re.escape(os.path.basename(gtfFile)) + r'\.annot_([0-9a-f]{32})(_[0-9a-f]{32}|_all)?\.pickle$')
+        for fileName in os.listdir(os.path.dirname(cacheFileName)):
+            cacheMatch = cachePattern.match(fileName)
+            if cacheMatch and cacheMatch.group(1) != checksum:
+                os.remove(os.path.join(os.path.dirname(cacheFileName), fileName))
+
+    return cacheFileName
+
+def loadChrGtf(gtfFile, nmSet=None):
+
+    """Load the parsed annotation of a gtf file (see parseChrGtf) from its binary cache, compiled if needed
+
+    A gtf compressed with bgzip and indexed with tabix (.gz file with a .tbi index) is not compiled, its chromosomes are
+    read when they are first queried (see TabixTranscriptStore).
+    If the cache can not be written or read the gtf is parsed.
+
+    :param gtfFile: a gtf file path
+    :type gtfFile: str
+    :param nmSet: nm ids of the transcripts to keep, None to keep all the transcripts
+    :type nmSet: set
+    :return transcriptStore: the transcripts annotations
+    :rtype: TranscriptStore or TabixTranscriptStore
+    """
+
+    if gtfFile.endswith('.gz') and os.path.exists(gtfFile + '.tbi'):
+        return TabixTranscriptStore(gtfFile, nmSet)
+
+    try:
+        with open(compileChrGtf(gtfFile, nmSet), 'rb') as cacheFile:
+            return cPickle.load(cacheFile)
+    except (IOError, OSError, EOFError, cPickle.UnpicklingError) as e:
+        logging.warning("cannot use the compiled annotation of {0} ({1}), the gtf will be parsed".format(gtfFile, e))
+        return parseChrGtf(gtfFile, nmSet)
+
+class TabixTranscriptStore(object):
+
+    """Transcript store of a gtf indexed with tabix, each chromosome is parsed in a TranscriptStore when it is first
+    queried
+
+    :param gtfFile: path of the gtf compressed with bgzip and indexed with tabix
+    :type gtfFile: str
+    :param nmSet: nm ids of the transcripts to keep, None to keep all the transcripts
+    :type nmSet: set
+    """
+
+    def __init__(self, gtfFile, nmSet=None):
+        import pysam
+
+        self.gtfTabix = pysam.TabixFile(gtfFile)
+        self.nmSet = nmSet
+        # chrom -> TranscriptStore of the chromosome
+        self.chromStoreDict = dict()
+
+    def getChromosomes(self):
+
+        """Return the list of the chromosomes of the gtf"""
+
+        return list(self.gtfTabix.contigs)
+
+    def getChromStore(self, chrom):
+
+        """Return the TranscriptStore of a chromosome, parsed at the first call"""
+
+        if chrom not in self.chromStoreDict:
+            if chrom in self.gtfTabix.contigs:
+                self.chromStoreDict[chrom] = parseGtfLines(self.gtfTabix.fetch(chrom), self.nmSet)
+            else:
+                self.chromStoreDict[chrom] = TranscriptStore(dict())
+
+        return self.chromStoreDict[chrom]
+
+    def getTranscript(self, chrom, nm):
+
+        """Return the Transcript of nm on chrom, None if it is not in the store"""
+
+        return self.getChromStore(chrom).getTranscript(chrom, nm)
+
+# (transcript, chromosome accession) -> (ExonBoundaryIndex, exon numbers) of the exons of the hgvs database
+HGVS_EXON_INDEX = dict()
 
 def getHgvsInfo(pos, var_g_p, txInfoList, chrAc, hdpConnexion):
-    txExonsList = hdpConnexion.get_tx_exons(txInfoList[3], chrAc, 'splign')
+    # imported here so that the tools which do not use hgvs (check_variants.py) do not need it
+    import hgvs.variantmapper
+
+    # exon boundaries of the transcript in the hgvs database, indexed once per transcript
+    indexKey = (txInfoList[3], chrAc)
+    if indexKey not in HGVS_EXON_INDEX:
+        txExonsList = hdpConnexion.get_tx_exons(txInfoList[3], chrAc, 'splign')
+        HGVS_EXON_INDEX[indexKey] = ExonBoundaryIndex([[exonList[8], exonList[9]] for exonList in txExonsList]), [int(exonList[5]) + 1 for exonList in txExonsList]
+    exonIndex, exonNumList = HGVS_EXON_INDEX[indexKey]
     variantmapper = hgvs.variantmapper.EasyVariantMapper(hdpConnexion, primary_assembly='GRCh37')
 
-    minDist = None
-    for exonList in txExonsList:
-        dist = min(abs(pos - exonList[8]), abs(pos - exonList[9]))
-        
-        if minDist == None: # initialisation
-            minDist = dist
-            exonNum = int(exonList[5]) + 1
-        else:
-            if dist < minDist:
-                minDist = dist
-                exonNum = int(exonList[5]) + 1
+    minDist, exonListIndex, side = exonIndex.getNearestBoundary(pos)
+    exonNum = exonNumList[exonListIndex]
 
     var_c_p = variantmapper.g_to_c(var_g_p, txInfoList[3])
 
     return var_c_p, exonNum, minDist
 
-def parsePileupLine(pileupLine):
-    chrom, pos, ref, depth, readBase, qual = pileupLine.rstrip('\n').split('\t')
-    
-    ref = ref.upper()
+def addIndelCount(indelCountDict, indelSeq):
+
+    """Add a read supporting an indel to the forward / reverse strand counts (upper case sequence for forward strand reads)"""
+
+    if indelSeq in indelCountDict:
+        indelCountDict[indelSeq][0] += 1
+    elif indelSeq.upper() in indelCountDict:
+        indelCountDict[indelSeq.upper()][1] += 1
+    elif indelSeq.isupper():
+        indelCountDict[indelSeq] = [1, 0]
+    else:
+        indelCountDict[indelSeq.upper()] = [0, 1]
+
+# characters starting a token of several characters in the mpileup read base column : read start (followed by the
+# mapping quality) and indel (followed by its size and sequence)
+PILEUP_TOKEN_START_RE = re.compile(r'[\^+-]')
+# characters of the read base column without the read starts and indels : read bases, match to reference on
+# forward / reverse strand, deletion (* or # on reverse strand), read end, reference skip
+PILEUP_BASE_CHARACTERS = 'ACGTNacgtn.,*#$<>'
+
+def countReadBases(chrom, pos, ref, readBase):
+
+    """Count the bases and indels of the read base column of a mpileup line in a single pass
+
+    A read followed by an indel counts in the depth for its base and for the indel.
+
+    :param chrom: the chromosome
+    :param pos: the position
+    :param ref: the reference base (upper case)
+    :param readBase: the read base column
+    :return: the pileup dict (see parsePileupLine)
+    """
 
     depth = 0
-    
-    countA = 0
-    countT = 0
-    countG = 0
-    countC = 0
-    countN = 0
-    counta = 0
-    countt = 0
-    countg = 0
-    countc = 0
-    countn = 0
     insCountDict = dict()
-    insString = '0'
     delCountDict = dict()
-    delString = '0'
-
-    # clean read base
-    readBase = re.sub('\^.', '', readBase)
-    readBase = re.sub('\$', '', readBase)
-
-    # find insertion and deletion
-    insMatch = re.findall('(\+[ATCGNatcgn0-9]+)', readBase)
-    delMatch = re.findall('(\-[ATCGNatcgn0-9]+)', readBase)
-
-    # handle insertion
-    for ins in insMatch:
-        depth += 1
-        insLen = int(re.findall('\+([0-9]+)', ins)[0])
-        insSeq = re.findall('\+' + str(insLen) + '([ATCGNatcgn]{' + str(insLen) + '})', ins)[0]
-        # clean readbase
-        readBase = re.sub('\+' + str(insLen) + insSeq, '', readBase)
-
-        # add count to count dict
-        if insSeq in insCountDict.keys():
-            insCountDict[insSeq][0] += 1
-        elif insSeq.upper() in insCountDict.keys():
-            insCountDict[insSeq.upper()][1] += 1
-        elif insSeq.isupper():
-            insCountDict[insSeq] = [1, 0]
-        else:
-            insCountDict[insSeq.upper()] = [0, 1]
-
-
-    # handle deletion
-    for deletion in delMatch:
-        depth += 1
-        delLen = int(re.findall('\-([0-9]+)', deletion)[0])
-        delSeq = re.findall('\-' + str(delLen) + '([ATCGNatcgn]{' + str(delLen) + '})', deletion)[0]
-        # clean readbase
-        readBase = re.sub('\-' + str(delLen) + delSeq, '', readBase)
-
-        # add count to count dict
-        if delSeq in delCountDict.keys():
-            delCountDict[delSeq][0] += 1
-        elif delSeq.upper() in delCountDict.keys():
-            delCountDict[delSeq.upper()][1] += 1
-        elif delSeq.isupper():
-            delCountDict[delSeq] = [1, 0]
+
+    # remove the read starts and count the indels, the remaining characters are one per read
+    baseList = list()
+    i = 0
+    while True:
+        match = PILEUP_TOKEN_START_RE.search(readBase, i)
+        if match is None:
+            baseList.append(readBase[i:])
+            break
+        tokenStart = match.start()
+        baseList.append(readBase[i:tokenStart])
+        if readBase[tokenStart] == '^':
+            i = tokenStart + 2
         else:
-            delCountDict[delSeq.upper()] = [0, 1]
-
-    # count snv
-    for base in readBase:
-        depth += 1
-        # get proper base for reference supporting reads
-        if base == '.':
-            base = ref
-        elif base == ',':
-            base = ref.lower()
-
-        if base == 'A': 
-            countA += 1
-        elif base =='a':
-            counta += 1
-        elif base == 'T':
-            countT += 1
-        elif base == 't':
-            countt += 1
-        elif base == 'C':
-            countC += 1
-        elif base == 'c':
-            countc += 1
-        elif base == 'G':
-            countG += 1
-        elif base == 'g':
-            countg += 1
-        elif base == 'N' or base == 'n':
-            countN += 1
-        elif base == '*':
-            if base in delCountDict.keys():
-                delCountDict[base][0] += 1
+            seqStart = tokenStart + 1
+            while readBase[seqStart].isdigit():
+                seqStart += 1
+            i = seqStart + int(readBase[tokenStart + 1:seqStart])
+            depth += 1
+            if readBase[tokenStart] == '+':
+                addIndelCount(insCountDict, readBase[seqStart:i])
             else:
-                delCountDict[base] = [1]
-        else:
-            raise Exception("invalid base in read base field : " + base + '\nline :' + line)
+                addIndelCount(delCountDict, readBase[seqStart:i])
+    bases = ''.join(baseList)
+
+    countDict = dict((base, bases.count(base)) for base in PILEUP_BASE_CHARACTERS)
+    if sum(countDict.values()) != len(bases):
+        invalidBase = bases.strip(PILEUP_BASE_CHARACTERS)[0]
+        raise Exception("invalid base in read base field : " + invalidBase + '\nposition :' + chrom + ':' + str(pos))
+
+    # read ends and reference skips are not read bases
+    depth += len(bases) - countDict['$'] - countDict['<'] - countDict['>']
 
     pileupDict = {
         'chrom' : chrom, 'pos': pos,
         'depth': depth, 'ref' : ref,
-        'A' : [countA, counta], 
-        'T' : [countT, countt], 
-        'C' : [countC, countc], 
-        'G' : [countG, countg],
-        'countN' : countN, 
+        'A' : [countDict['A'], countDict['a']],
+        'T' : [countDict['T'], countDict['t']],
+        'C' : [countDict['C'], countDict['c']],
+        'G' : [countDict['G'], countDict['g']],
+        'countN' : countDict['N'] + countDict['n'],
         'ins' : insCountDict, 'del' : delCountDict
     }
+
+    # get proper base for reference supporting reads
+    if countDict['.'] or countDict[',']:
+        if ref in 'ACGT':
+            pileupDict[ref][0] += countDict['.']
+            pileupDict[ref][1] += countDict[',']
+        elif ref == 'N':
+            pileupDict['countN'] += countDict['.'] + countDict[',']
+        else:
+            raise Exception("invalid base in read base field : " + ref + '\nposition :' + chrom + ':' + str(pos))
+
+    if countDict['*'] or countDict['#']:
+        delCountDict['*'] = [countDict['*'] + countDict['#']]
+
     return pileupDict
 
-def getCount(chrom, pos, refSeq, altSeq, mapQThreshold, baseQThreshold, refFastaFileName, bamFileName):
+def parsePileupLine(pileupLine):
+
+    """Count the bases and indels of a samtools mpileup line
+
+    :return: dict with chrom, pos, depth, ref, forward / reverse strand counts of A, T, C, G, countN, and forward /
+        reverse strand counts of each inserted ('ins') and deleted ('del') sequence ('*' for reads in a deletion)
+    """
+
+    chrom, pos, ref, depth, readBase, qual = pileupLine.rstrip('\n').split('\t')
+
+    return countReadBases(chrom, pos, ref.upper(), readBase)
+
+def getPileupIterator(BamFile, refFasta, chrom, start, end, mapQThreshold, baseQThreshold, maxDepth=1000000, multipleIterators=False):
+
+    """Iterate over the pileup columns of a region (0-based, end excluded) with the read filters of
+    "samtools mpileup -AB -q mapQThreshold -Q baseQThreshold -d maxDepth"
+
+    :param multipleIterators: open the bam file again, so that the iterator can run while another one is alive
+    """
+
+    # -A keeps orphan reads, -B disables BAQ, overlapping mates are detected like in mpileup
+    return BamFile.pileup(chrom, start, end, truncate=True, stepper='samtools', fastafile=refFasta, ignore_orphans=False,
+        compute_baq=False, min_mapping_quality=mapQThreshold, min_base_quality=baseQThreshold,
+        max_depth=maxDepth, ignore_overlaps=True, multiple_iterators=multipleIterators)
+
+def getPileupDict(chrom, pos, BamFile, refFasta, mapQThreshold, baseQThreshold, readSampleSize=0, readSampleSeed=0):
+
+    """Count the bases and indels of the reads covering a position, as parsePileupLine does on the output of
+    "samtools mpileup -AB -q mapQThreshold -Q baseQThreshold -d 1000000" but in process
+
+    :param chrom: the chromosome
+    :param pos: the position (1-based)
+    :param BamFile: the open bam file
+    :type BamFile: pysam.AlignmentFile
+    :param refFasta: the open reference fasta file
+    :type refFasta: pysam.FastaFile
+    :param readSampleSize: maximum number of reads of the read level metrics (see getReadMetrics), 0 for all the reads
+    :param readSampleSeed: seed of the read sampling
+    :return: the pileup dict (see parsePileupLine) with the read level metrics of the column (see getPileupColumnDict)
+    :raises ValueError: if no read covers the position
+    """
+
+    # the column is only valid while its iterator is alive
+    pileupIt = getPileupIterator(BamFile, refFasta, chrom, pos - 1, pos, mapQThreshold, baseQThreshold)
+    PileupColumn = next(pileupIt, None)
+    if PileupColumn is None:
+        raise ValueError('no read covers position {0} on chromosome {1}'.format(pos, chrom))
+
+    readMetricsDict = getColumnReadMetrics(chrom, pos, PileupColumn, BamFile, refFasta, mapQThreshold, baseQThreshold,
+        readSampleSize, readSampleSeed)
+
+    return getPileupColumnDict(chrom, pos, PileupColumn, refFasta, readMetricsDict)
+
+def getPileupColumnDict(chrom, pos, PileupColumn, refFasta, readMetricsDict=None):
+
+    """Count the bases and indels of the reads of a pileup column (see getPileupDict), and store their read level
+    metrics in 'reads' (readMetricsDict, see getColumnReadMetrics, or the metrics of all the reads of the column)
+
+    The metrics are collected on the reads of the counted column, so the mapping and base quality filters of the pileup
+    apply to them too (the distances of table_maker were taken on an unfiltered pileup before).
+    """
+
+    # mpileup read base column without read starts and ends, deleted bases are read in the fasta given to the pileup
+    # when all the reads of the column are filtered out, mpileup prints a '*' placeholder (counted as a read in a deletion)
+    readBase = ''.join(PileupColumn.get_query_sequences(mark_matches=False, mark_ends=False, add_indels=True)) or '*'
+    pileupDict = countReadBases(chrom, str(pos), refFasta.fetch(chrom, pos - 1, pos).upper(), readBase)
+    # read level metrics from the same column, not available in the pileup dicts of mpileup lines
+    pileupDict['reads'] = readMetricsDict if readMetricsDict is not None else getReadMetrics(pos, PileupColumn)
+
+    return pileupDict
+
+def getCount(chrom, pos, refSeq, altSeq, mapQThreshold, baseQThreshold, refFasta, BamFile, pLineDict=None, readSampleSize=0, readSampleSeed=0):
 
     """Get allelic ratio, depth and bases counts
 
@@ -278,69 +926,55 @@ def getCount(chrom, pos, refSeq, altSeq, mapQThreshold, baseQThreshold, refFasta
     :param altSeq: the sequence of the variant
     :param mapQThreshold:
     :param baseQThreshold:
-    :param refFastaFileName:
-    :param bamFileName:
+    :param refFasta: the open reference fasta file
+    :param BamFile: the open bam file
+    :param pLineDict: pileup dict of the position already counted (see sweepSampleReads), read from the bam if None
+    :param readSampleSize: maximum number of reads of the read level metrics (see getReadMetrics), 0 for all the reads
+    :param readSampleSeed: seed of the read sampling
     :return freq, depth, varCount, varCountF, varCountR: 
     """
 
-    try:
-        lenRef = len(refSeq)
-        lenAlt = len(altSeq)
-
-        tempPileupFile = tempfile.NamedTemporaryFile(mode="a+b", delete = False)
-        tempFileName = tempPileupFile.name
-        cmd = ' '.join(["samtools", "mpileup", "-AB", "-f", refFastaFileName, 
-            "-q", str(mapQThreshold), "-Q", str(baseQThreshold), "-d 1000000",
-            "-r", chrom + ':' + str(pos) + '-' + str(pos), bamFileName]
-        )
-        sp = subprocess.Popen(cmd, stdout = tempPileupFile, stderr=STDERR_FILE, shell=True)
-        sp.wait()
-        tempPileupFile.close()
-        pileupFile = open(tempFileName, 'r')
-
-        pileupLine = pileupFile.readline()
-        pLineDict = parsePileupLine(pileupLine)
-
-        # initialize counters
-        varCount = 0
-        varCountF = 0
-        varCountR = 0
-
-        # handle snv
-        if lenRef == lenAlt:
-            varCount = sum(pLineDict[altSeq])
-            varCountF = pLineDict[altSeq][0]
-            varCountR = pLineDict[altSeq][1]
-
-        # handle del
-        elif lenRef > lenAlt : 
-            diff =  lenRef - lenAlt
-            varCount = 0
-            for delSeq, countList in zip(pLineDict['del'].keys(), pLineDict['del'].values()):
-                if len(delSeq) >= diff and delSeq != '*':
-                    varCount += sum(countList)
-                    varCountF += countList[0]
-                    varCountR += countList[1]
-
-        # handle ins
-        elif lenRef < lenAlt: 
-            diff = lenAlt - lenRef
-            varCount = 0
-            for insSeq, countList in zip(pLineDict['ins'].keys(), pLineDict['ins'].values()):
-                if insSeq[:diff].upper() == altSeq[lenRef:].upper():
-                    varCount += sum(countList)
-                    varCountF += countList[0]
-                    varCountR += countList[1]
-
-        if pLineDict['depth'] != 0:
-            freq = '%.2f' % ((float(varCount)/float(pLineDict['depth'])) * 100)
-        else:
-            freq = "NA"
+    lenRef = len(refSeq)
+    lenAlt = len(altSeq)
 
-    finally:
-        if tempFileName:
-            pileupFile.close()
-            os.remove(tempFileName)
+    if pLineDict is None:
+        pLineDict = getPileupDict(chrom, pos, BamFile, refFasta, mapQThreshold, baseQThreshold, readSampleSize, readSampleSeed)
+
+    # initialize counters
+    varCount = 0
+    varCountF = 0
+    varCountR = 0
+
+    # handle snv
+    if lenRef == lenAlt:
+        varCount = sum(pLineDict[altSeq])
+        varCountF = pLineDict[altSeq][0]
+        varCountR = pLineDict[altSeq][1]
+
+    # handle del
+    elif lenRef > lenAlt : 
+        diff =  lenRef - lenAlt
+        varCount = 0
+        for delSeq, countList in zip(pLineDict['del'].keys(), pLineDict['del'].values()):
+            if len(delSeq) >= diff and delSeq != '*':
+                varCount += sum(countList)
+                varCountF += countList[0]
+                varCountR += countList[1]
+
+    # handle ins
+    elif lenRef < lenAlt: 
+        diff = lenAlt - lenRef
+        varCount = 0
+        for insSeq, countList in zip(pLineDict['ins'].keys(), pLineDict['ins'].values()):
+            if insSeq[:diff].upper() == altSeq[lenRef:].upper():
+                varCount += sum(countList)
+                varCountF += countList[0]
+                varCountR += countList[1]
+
+    if pLineDict['depth'] != 0:
+        freq = '%.2f' % ((float(varCount)/float(pLineDict['depth'])) * 100)
+    else:
+        freq = "NA"
 
     # get strand biases
     try:
@@ -397,19 +1031,15 @@ def getGranthamScore(refAA, altAA, prefered_nm, granthamDict):
     else:
         return "NA"
 
-def getSpliceDist(chrom, pos, prefered_nm, annotDict):
+def getSpliceDist(chrom, pos, prefered_nm, transcriptStore):
 
         if prefered_nm == "NA":
             return "NA"
         else:
-            spliceDistList = list()
-            exonList = annotDict[chrom][prefered_nm]['exons']
-            for exon in exonList:
-                spliceDistList.append(abs(pos - int(exon[0])))
-                spliceDistList.append(abs(pos - int(exon[1])))
-
-            if len(spliceDistList) != 0:
-                return min(spliceDistList)
+            transcript = transcriptStore.getTranscript(chrom, prefered_nm)
+            nearestBoundary = transcript.getNearestBoundary(pos) if transcript is not None else None
+            if nearestBoundary is not None:
+                return nearestBoundary[0]
             else:
                 return "NA"
 
@@ -422,70 +1052,609 @@ def median(numList):
     else:
         return float(sum(numList[(len(numList)/2) - 1:(len(numList)/2) + 1]))/2.0
 
+def medianArray(valueArray):
+
+    """Same value as median for a numpy array, found by selection (numpy.partition) instead of a sort"""
+
+    n = len(valueArray)
+    if n < 1:
+        return None
+    if n % 2 == 1:
+        return float(numpy.partition(valueArray, n // 2)[n // 2])
+    partitionArray = numpy.partition(valueArray, [n // 2 - 1, n // 2])
+
+    return float(partitionArray[n // 2 - 1] + partitionArray[n // 2]) / 2.0
+
+# positions are smaller than this factor, so that each (seed, position) gives a different sampling of the reads
+READ_SAMPLE_SEED_FACTOR = 1000000007
+
+def getReadMetrics(pos, PileupColumn, sampleSize=0, seed=0):
+
+    """Collect the read level metrics of a pileup column, visiting each read once
+
+    Above sampleSize reads, the metrics are calculated on a uniform sample of sampleSize reads. The sample only
+    depends on seed and pos, so runs (and the default and sweep modes of table_maker) report the same values.
+    pysam builds the whole PileupColumn.pileups list before the sampling, getColumnReadMetrics bounds it.
+
+    :param pos: the position of the column (1-based)
+    :param PileupColumn: the pileup column of the position
+    :type PileupColumn: pysam.PileupColumn
+    :param sampleSize: maximum number of reads visited, 0 for all the reads
+    :param seed: seed of the read sampling
+    :return: dict with 'sampled' (True if the reads were sampled), 'reads' (number of reads, secondary alignments excluded), 'start_dist' and 'end_dist' (int arrays,
+        distance between the position and the start / end of each read), 'read_pos' (int array, distance between the
+        position and the nearest end of the sequence of each read, reads with a deletion at the position excluded),
+        'mate_unmapped' and 'mate_other_chrom' (number of paired reads whose mate is unmapped / on another chromosome)
+    """
+
+    pileupReadList = PileupColumn.pileups
+    sampled = 0 < sampleSize < len(pileupReadList)
+    if sampled:
+        # sample of the read indexes, visited in the column order
+        sampleRandom = random.Random(seed * READ_SAMPLE_SEED_FACTOR + pos)
+        pileupReadList = [pileupReadList[i] for i in sorted(sampleRandom.sample(xrange(len(pileupReadList)), sampleSize))]
+    startDistArray = numpy.empty(len(pileupReadList), dtype=numpy.int64)
+    endDistArray = numpy.empty(len(pileupReadList), dtype=numpy.int64)
+    readPosArray = numpy.empty(len(pileupReadList), dtype=numpy.int64)
+    nRead = 0
+    nReadPos = 0
+    nMateUnmapped = 0
+    nMateOtherChrom = 0
+
+    for PileupRead in pileupReadList:
+        alignment = PileupRead.alignment
+        if alignment.is_secondary:
+            continue
+        startDistArray[nRead] = abs(pos - alignment.reference_start)
+        endDistArray[nRead] = abs(pos - alignment.reference_end)
+        nRead += 1
+
+        if alignment.is_paired:
+            if alignment.mate_is_unmapped:
+                nMateUnmapped += 1
+            elif alignment.next_reference_id != alignment.reference_id:
+                nMateOtherChrom += 1
+
+        if not PileupRead.is_del and not PileupRead.is_refskip:
+            queryPos = PileupRead.query_position
+            readPosArray[nReadPos] = min(queryPos, alignment.query_length - 1 - queryPos)
+            nReadPos += 1
+
+    return {
+        'sampled' : sampled, 'reads' : nRead,
+        'start_dist' : startDistArray[:nRead], 'end_dist' : endDistArray[:nRead],
+        'read_pos' : readPosArray[:nReadPos],
+        'mate_unmapped' : nMateUnmapped, 'mate_other_chrom' : nMateOtherChrom
+    }
+
+# the capped pileup of the read level metrics holds this many reads per read of the sample
+READ_SAMPLE_DEPTH_FACTOR = 2
+
+def getColumnReadMetrics(chrom, pos, PileupColumn, BamFile, refFasta, mapQThreshold, baseQThreshold, sampleSize=0, seed=0):
+
+    """Collect the read level metrics of a pileup column (see getReadMetrics) with a bounded work above sampleSize reads
+
+    Listing the reads of a column (PileupColumn.pileups) takes most of the time of deep columns. Above sampleSize
+    reads, the metrics are calculated on a second pileup of the position, capped at READ_SAMPLE_DEPTH_FACTOR *
+    sampleSize reads (samtools mpileup -d), and the sample is drawn among its reads. The cap drops the reads that
+    start while the pileup is full, so the kept reads are not a uniform sample of the column. The allele counts
+    stay on the uncapped column.
+
+    :param PileupColumn: the uncapped pileup column of the position
+    :type PileupColumn: pysam.PileupColumn
+    :param BamFile: the open bam file of the column
+    :type BamFile: pysam.AlignmentFile
+    :return: the read level metrics dict (see getReadMetrics), 'sampled' is True for the capped pileup
+    """
+
+    if 0 < sampleSize < PileupColumn.get_num_aligned():
+        # the capped pileup runs on its own file handle, the uncapped iterator of the column stays alive
+        pileupIt = getPileupIterator(BamFile, refFasta, chrom, pos - 1, pos, mapQThreshold, baseQThreshold,
+            READ_SAMPLE_DEPTH_FACTOR * sampleSize, True)
+        SampleColumn = next(pileupIt, None)
+        if SampleColumn is not None:
+            readMetricsDict = getReadMetrics(pos, SampleColumn, sampleSize, seed)
+            readMetricsDict['sampled'] = True
+            return readMetricsDict
+
+    return getReadMetrics(pos, PileupColumn, sampleSize, seed)
+
+def getReadDistStats(readMetricsDict):
+
+    """Max, median and min of the distances from reads start then from reads end (see getReadMetrics)
+
+    :raises ValueError: if there is no read
+    """
+
+    if readMetricsDict['reads'] == 0:
+        raise ValueError('no read to calculate distances')
+    startDistArray = readMetricsDict['start_dist']
+    endDistArray = readMetricsDict['end_dist']
+
+    return startDistArray.max(), medianArray(startDistArray), startDistArray.min(), endDistArray.max(), medianArray(endDistArray), endDistArray.min()
+
+def getReadPositionStats(readMetricsDict):
+
+    """Min, median and max of the distances between the position and the nearest end of the reads sequences, then the
+    number of reads with an unmapped mate and with a mate on another chromosome (see getReadMetrics)"""
+
+    readPosArray = readMetricsDict['read_pos']
+    if len(readPosArray) == 0:
+        posStatList = ["NA", "NA", "NA"]
+    else:
+        posStatList = [readPosArray.min(), medianArray(readPosArray), readPosArray.max()]
+
+    return posStatList + [readMetricsDict['mate_unmapped'], readMetricsDict['mate_other_chrom']]
+
 def getDistFromReadsStartEnd(chrom, pos, BamFile):
-    pileupIt = BamFile.pileup(chrom, pos, pos + 1)
-    endDistList = list()
-    startDistList = list()
 
-    for PileupColumn in pileupIt:
-        for PileupRead in PileupColumn.pileups:
-            if not PileupRead.alignment.is_secondary:
-                endDistList.append(abs(pos - PileupRead.alignment.aend))
-                startDistList.append(abs(pos - PileupRead.alignment.pos))
+    """Max, median and min of the distances between a position and the start / end of the reads covering it
+
+    :raises ValueError: if no read covers the position
+    """
+
+    # the column is only valid while its iterator is alive
+    pileupIt = BamFile.pileup(chrom, pos - 1, pos, truncate=True)
+    PileupColumn = next(pileupIt, None)
+    if PileupColumn is None:
+        raise ValueError('no read covers position {0} on chromosome {1}'.format(pos, chrom))
+
+    return getReadDistStats(getReadMetrics(pos, PileupColumn))
+
+# positions closer than this distance are read in the same pileup by sweepSampleReads
+SWEEP_MERGE_DISTANCE = 500
+
+def sweepSampleReads(variantList, BamFile, refFasta, mapQThreshold, baseQThreshold, readSampleSize=0, readSampleSeed=0):
+
+    """Read the bam once in coordinate order for all the variants of a sample
+
+    The positions are sorted and merged in regions, and each region is read in one pileup.
+
+    :param variantList: list of (chrom, pos, ref, alt) (pos is 1-based)
+    :param BamFile: the open bam file
+    :type BamFile: pysam.AlignmentFile
+    :param refFasta: the open reference fasta file
+    :type refFasta: pysam.FastaFile
+    :param readSampleSize: maximum number of reads of the read level metrics (see getReadMetrics), 0 for all the reads
+    :param readSampleSeed: seed of the read sampling
+    :return: dict (chrom, pos) -> pileup dict with read level metrics (see getPileupColumnDict), positions not covered by
+        any read are not in the dict
+    """
+
+    # merged regions (chrom, first position, last position) in bam order
+    chromOrderDict = dict((chrom, i) for i, chrom in enumerate(BamFile.references))
+    posList = sorted(set((chrom, pos) for chrom, pos, ref, alt in variantList if chrom in chromOrderDict),
+        key=lambda chromPos: (chromOrderDict[chromPos[0]], chromPos[1]))
+    regionList = list()
+    for chrom, pos in posList:
+        if regionList and regionList[-1][0] == chrom and pos - regionList[-1][2] <= SWEEP_MERGE_DISTANCE:
+            regionList[-1][2] = pos
+        else:
+            regionList.append([chrom, pos, pos])
+
+    readDataDict = dict()
+    posSet = set(posList)
+    for chrom, start, end in regionList:
+        for PileupColumn in getPileupIterator(BamFile, refFasta, chrom, start - 1, end, mapQThreshold, baseQThreshold):
+            pos = PileupColumn.reference_pos + 1
+            if (chrom, pos) not in posSet:
+                continue
+            readMetricsDict = getColumnReadMetrics(chrom, pos, PileupColumn, BamFile, refFasta, mapQThreshold,
+                baseQThreshold, readSampleSize, readSampleSeed)
+            readDataDict[(chrom, pos)] = getPileupColumnDict(chrom, pos, PileupColumn, refFasta, readMetricsDict)
+
+    return readDataDict
+
+class PileupCache(object):
+
+    """Per sample cache of the pileup dicts and read metric summaries of positions, so that the alleles of a
+    multi-allelic site and repeated positions are read once from the bam
+
+    Entries are keyed by position and read filters. Positions not covered by any read are cached as None.
+
+    :param BamFile: the open bam file of the sample
+    :type BamFile: pysam.AlignmentFile
+    :param refFasta: the open reference fasta file
+    :type refFasta: pysam.FastaFile
+    :param readSampleSize: maximum number of reads of the read level metrics (see getReadMetrics), 0 for all the reads
+    :param readSampleSeed: seed of the read sampling
+    """
+
+    def __init__(self, BamFile, refFasta, mapQThreshold, baseQThreshold, readSampleSize=0, readSampleSeed=0):
+        self.BamFile = BamFile
+        self.refFasta = refFasta
+        self.filterKey = (mapQThreshold, baseQThreshold, readSampleSize, readSampleSeed)
+        self.pileupDict = dict()
+        self.readStatsDict = dict()
+        self.hits = 0
+        self.misses = 0
+
+    def sweep(self, variantList):
+
+        """Fill the cache with the positions of variantList read in one pass over the bam (see sweepSampleReads)"""
+
+        readDataDict = sweepSampleReads(variantList, self.BamFile, self.refFasta, *self.filterKey)
+        for chrom, pos, ref, alt in variantList:
+            self.pileupDict[(chrom, pos) + self.filterKey] = readDataDict.get((chrom, pos))
+
+    def getPileupDict(self, chrom, pos):
+
+        """Return the pileup dict of a position (see getPileupDict) or None if no read covers it"""
+
+        key = (chrom, pos) + self.filterKey
+        if key in self.pileupDict:
+            self.hits += 1
+            return self.pileupDict[key]
+
+        self.misses += 1
+        try:
+            pileupDict = getPileupDict(chrom, pos, self.BamFile, self.refFasta, *self.filterKey)
+        except ValueError:
+            pileupDict = None
+        self.pileupDict[key] = pileupDict
+
+        return pileupDict
+
+    def getReadStats(self, chrom, pos):
+
+        """Return the distances from reads start / end (see getReadDistStats, None if there is no read) and the read
+        position stats (see getReadPositionStats) of a position"""
+
+        key = (chrom, pos) + self.filterKey
+        if key not in self.readStatsDict:
+            pileupDict = self.getPileupDict(chrom, pos)
+            if pileupDict is None:
+                self.readStatsDict[key] = None, ["NA", "NA", "NA", 0, 0]
+            else:
+                try:
+                    readDistList = getReadDistStats(pileupDict['reads'])
+                except ValueError:
+                    readDistList = None
+                self.readStatsDict[key] = readDistList, getReadPositionStats(pileupDict['reads'])
+
+        return self.readStatsDict[key]
+
+    def getStats(self):
+
+        """Return a string with hit and miss counters of the pileup dicts"""
+
+        return "hits: {0}, misses: {1}".format(self.hits, self.misses)
+
+# read bases of the count arrays of getRegionCountArrays, and their ascii codes on forward (upper case) and reverse
+# strand (lower case)
+COUNT_ARRAY_BASES = 'ACGTN'
+if numpy is not None:
+    COUNT_ARRAY_CODES = numpy.array([[ord(base), ord(base.lower())] for base in COUNT_ARRAY_BASES])
+
+def getRegionCountArrays(chrom, start, end, BamFile, refFasta, mapQThreshold, baseQThreshold):
+
+    """Count the read bases of each position of a region in arrays, with the read filters of getPileupDict
+
+    :param start: first position of the region (1-based)
+    :param end: last position of the region (included)
+    :return: dict with 'chrom', 'start', 'ref' (reference sequence of the region, upper case), 'covered' (bool array,
+        positions with a pileup column), 'counts' (int32 array positions x COUNT_ARRAY_BASES x forward / reverse
+        strand), 'deleted' (reads in a deletion), 'depth' (see parsePileupLine), 'ins' and 'del' (dict position index
+        -> indel sequence -> forward / reverse strand counts, only for positions with indels)
+    """
+
+    nPos = end - start + 1
+    regionDict = {
+        'chrom' : chrom, 'start' : start,
+        'ref' : refFasta.fetch(chrom, start - 1, end).upper(),
+        'covered' : numpy.zeros(nPos, dtype=bool),
+        'counts' : numpy.zeros((nPos, len(COUNT_ARRAY_BASES), 2), dtype=numpy.int32),
+        'deleted' : numpy.zeros(nPos, dtype=numpy.int32),
+        'depth' : numpy.zeros(nPos, dtype=numpy.int32),
+        'ins' : dict(), 'del' : dict()
+    }
+
+    for PileupColumn in getPileupIterator(BamFile, refFasta, chrom, start - 1, end, mapQThreshold, baseQThreshold):
+        i = PileupColumn.reference_pos - (start - 1)
+        readBaseList = PileupColumn.get_query_sequences(mark_matches=False, mark_ends=False, add_indels=True)
+        bases = ''.join(readBaseList)
+
+        # as in parsePileupLine, a read with an indel counts for the indel and for its base
+        nIndel = 0
+        if len(bases) != len(readBaseList):
+            bases = ''.join(readBase[0] for readBase in readBaseList)
+            for readBase in readBaseList:
+                if len(readBase) > 1:
+                    nIndel += 1
+                    indelDict = regionDict['ins'] if readBase[1] == '+' else regionDict['del']
+                    addIndelCount(indelDict.setdefault(i, dict()), readBase[2:].lstrip('0123456789'))
+
+        regionDict['covered'][i] = True
+        # '*' placeholder of mpileup when all the reads of the column are filtered out (see getPileupColumnDict)
+        bases = bases or '*'
+        charCountArray = numpy.bincount(numpy.frombuffer(bases, dtype=numpy.uint8), minlength=256)
+        regionDict['counts'][i] = charCountArray[COUNT_ARRAY_CODES]
+        regionDict['deleted'][i] = charCountArray[ord('*')] + charCountArray[ord('#')]
+        # reference skips are not read bases
+        regionDict['depth'][i] = len(bases) - charCountArray[ord('<')] - charCountArray[ord('>')] + nIndel
+
+    return regionDict
+
+# 2-bit code of each ascii character, 4 for characters which are not a base
+if numpy is not None:
+    BASE_CODE_ARRAY = numpy.empty(256, dtype=numpy.uint8)
+    BASE_CODE_ARRAY.fill(4)
+    for i, base in enumerate('ACGT'):
+        BASE_CODE_ARRAY[ord(base)] = i
+        BASE_CODE_ARRAY[ord(base.lower())] = i
+
+# maxentscan models, compiled once in a binary bundle and memory-mapped once per process
+MES_MODELS = dict()
+MES_TABLE_SIZE = 16384
+# source tables of the bundle rows: row 0 is the 5' donor model, rows 1 to 9 are the 3' acceptor models
+MES_DONOR_FILES = ['me2x5', 'splicemodels/splice5sequences']
+MES_ACCEPTOR_FILES = ['splicemodels/me2x3acc' + str(i) for i in xrange(1, 10)]
+MES_ACCEPTOR_SIZES = [16384, 16384, 16384, 16384, 16384, 64, 256, 64, 256]
+# (start, length) of the 9 hashed sub-sequences in the 21 bases without the AG consensus (see score3.pl)
+MES_ACCEPTOR_HASHES = [(0, 7), (7, 7), (14, 7), (4, 7), (11, 7), (4, 3), (7, 4), (11, 3), (14, 4)]
+if numpy is not None:
+    # consensus and background frequencies indexed by 2-bit base code (A=0, C=1, G=2, T=3)
+    MES_BGD_ARRAY = numpy.array([0.27, 0.23, 0.23, 0.27])
+    MES_DONOR_CONS1_ARRAY = numpy.array([0.004, 0.0032, 0.9896, 0.0032])
+    MES_DONOR_CONS2_ARRAY = numpy.array([0.0034, 0.0039, 0.0042, 0.9884])
+    MES_DONOR_REST = numpy.array([0, 1, 2, 5, 6, 7, 8])
+    MES_ACCEPTOR_CONS1_ARRAY = numpy.array([0.9903, 0.0032, 0.0034, 0.0030])
+    MES_ACCEPTOR_CONS2_ARRAY = numpy.array([0.0027, 0.0037, 0.9905, 0.0030])
+    MES_ACCEPTOR_REST = numpy.array(range(0, 18) + range(20, 23))
+    # weights of each base in the base 4 hash of a sequence of a given length
+    HASH_POWERS = [4 ** numpy.arange(length - 1, -1, -1) for length in xrange(0, 10)]
+
+def encodeSequences(seqList, seqLength):
+
+    """Encode sequences of the same length as 2-bit integer arrays (A=0, C=1, G=2, T=3)
+
+    :param seqList: list of sequences
+    :type seqList: list
+    :param seqLength: expected length of the sequences
+    :type seqLength: int
+    :return codeArray, validArray: a (n, seqLength) uint8 array and a boolean array set to False
+        for sequences of the wrong length or containing other bases than ACGT (encoded as 0)
+    :rtype: tuple
+    """
+
+    validArray = numpy.fromiter(map(len, seqList), dtype=numpy.int64, count=len(seqList)) == seqLength
+    if validArray.all():
+        joinedSeq = ''.join(seqList)
+        codeArray = BASE_CODE_ARRAY.take(numpy.frombuffer(joinedSeq, dtype=numpy.uint8)).reshape(-1, seqLength)
+    else:
+        codeArray = numpy.zeros((len(seqList), seqLength), dtype=numpy.uint8)
+        if validArray.any():
+            joinedSeq = ''.join([seq for seq in seqList if len(seq) == seqLength])
+            codeArray[validArray] = BASE_CODE_ARRAY.take(numpy.frombuffer(joinedSeq, dtype=numpy.uint8)).reshape(-1, seqLength)
+    validArray &= (codeArray < 4).all(axis=1)
+    if not validArray.all():
+        codeArray[~validArray] = 0
+
+    return codeArray, validArray
+
+def hashCodes(codeArray):
+
+    """Base 4 hash of 2-bit encoded sequences (same as hashseq in score3.pl)
+
+    :param codeArray: a (n, length) array of base codes
+    :type codeArray: numpy.ndarray
+    :return hashArray: a (n,) array of table indexes
+    :rtype: numpy.ndarray
+    """
+
+    return codeArray.dot(HASH_POWERS[codeArray.shape[1]])
+
+def getMesModelsChecksum(mesScriptDir):
+
+    """md5 checksum of the maxentscan text tables compiled in the binary bundle"""
+
+    md5 = hashlib.md5()
+    for fileName in MES_DONOR_FILES + MES_ACCEPTOR_FILES:
+        with open(os.path.join(mesScriptDir, fileName), 'rb') as tableFile:
+            md5.update(tableFile.read())
+
+    return md5.hexdigest()
+
+def parseMesModels(mesScriptDir):
+
+    """Parse the maxentscan text tables in a (10, 16384) float array indexed by hashed sequence
+
+    Row 0 is me2x5 reordered with splice5sequences, rows 1 to 9 are me2x3acc1 to me2x3acc9
+    (tables shorter than 16384 are padded with 1).
+
+    :param mesScriptDir: path of the maxentscan directory
+    :type mesScriptDir: str
+    :return modelArray: the model array
+    :rtype: numpy.ndarray
+    """
+
+    modelArray = numpy.ones((len(MES_ACCEPTOR_FILES) + 1, MES_TABLE_SIZE), dtype=numpy.float64)
+
+    donorScores = numpy.loadtxt(os.path.join(mesScriptDir, MES_DONOR_FILES[0]), dtype=numpy.float64)
+    with open(os.path.join(mesScriptDir, MES_DONOR_FILES[1]), 'r') as seqFile:
+        donorSeqList = [line.strip() for line in seqFile]
+    codeArray, validArray = encodeSequences(donorSeqList, 7)
+    if not validArray.all() or len(donorSeqList) != len(donorScores):
+        raise Exception("invalid maxentscan donor tables in " + mesScriptDir)
+    modelArray[0][hashCodes(codeArray)] = donorScores
+
+    for i, fileName in enumerate(MES_ACCEPTOR_FILES):
+        tableArray = numpy.loadtxt(os.path.join(mesScriptDir, fileName), dtype=numpy.float64)
+        if len(tableArray) != MES_ACCEPTOR_SIZES[i]:
+            raise Exception("invalid maxentscan acceptor table " + fileName)
+        modelArray[i + 1][:len(tableArray)] = tableArray
+
+    return modelArray
+
+def compileMesModels(mesScriptDir):
+
+    """Write the binary bundle of the maxentscan tables next to the text tables
+
+    The bundle is named after the checksum of the text tables so it is rebuilt when they change (see writeFileAtomically).
+
+    :param mesScriptDir: path of the maxentscan directory
+    :type mesScriptDir: str
+    :return bundleFileName: path of the bundle
+    :rtype: str
+    """
+
+    mesScriptDir = os.path.realpath(mesScriptDir)
+    checksum = getMesModelsChecksum(mesScriptDir)
+    bundleFileName = os.path.join(mesScriptDir, 'splicemodels', 'mes_models_' + checksum + '.npy')
+    if not os.path.exists(bundleFileName):
+        modelArray = parseMesModels(mesScriptDir)
+        writeFileAtomically(bundleFileName, lambda bundleFile: numpy.save(bundleFile, modelArray))
+
+        # remove bundles compiled from previous versions of the tables
+        for fileName in os.listdir(os.path.dirname(bundleFileName)):
+            if re.match(r'mes_models_[0-9a-f]{32}\.npy$', fileName) and fileName != os.path.basename(bundleFileName):
+                os.remove(os.path.join(os.path.dirname(bundleFileName), fileName))
+
+    return bundleFileName
+
+def loadMesModels(mesScriptDir):
+
+    """Load the maxentscan models once per process
+
+    The binary bundle is compiled if needed and memory-mapped, so processes share the same pages.
+    If the bundle can not be written the text tables are parsed in memory.
+
+    :param mesScriptDir: path of the maxentscan directory
+    :type mesScriptDir: str
+    :return donorArray, acceptorList: donor table and list of the 9 acceptor tables indexed by hashed sequence
+    :rtype: tuple
+    """
+
+    if mesScriptDir not in MES_MODELS:
+        try:
+            # plain array view of the memory map (indexing a numpy.memmap is slower)
+            modelArray = numpy.asarray(numpy.load(compileMesModels(mesScriptDir), mmap_mode='r'))
+        except (IOError, OSError) as e:
+            logging.warning("cannot compile maxentscan models in {0} ({1}), text tables will be parsed".format(mesScriptDir, e))
+            modelArray = parseMesModels(mesScriptDir)
+        acceptorList = [modelArray[i + 1][:size] for i, size in enumerate(MES_ACCEPTOR_SIZES)]
+        MES_MODELS[mesScriptDir] = (modelArray[0], acceptorList)
+
+    return MES_MODELS[mesScriptDir]
+
+def roundMesScore(score):
+
+    """Round a maxentscan score as the perl scripts do (sprintf %.2f), nan gives None"""
+
+    if numpy.isnan(score):
+        return None
+    return float('%.2f' % score)
+
+def getMaxMesScore(scoreArray):
+
+    """Rounded maximum of a maxentscan score array, raise ValueError if no window could be scored"""
+
+    scoreArray = scoreArray[~numpy.isnan(scoreArray)]
+    if len(scoreArray) == 0:
+        raise ValueError("no maxentscan score available")
+    return roundMesScore(scoreArray.max())
+
+def getMesDonorScoreArray(seqList, mesScriptDir):
+
+    """Score 9-mers with the maxentscan 5' donor model in a single vectorized call
+
+    :param seqList: list of 9 bases sequences (3 exonic bases + 6 intronic bases)
+    :type seqList: list
+    :param mesScriptDir: path of the maxentscan directory
+    :type mesScriptDir: str
+    :return scoreArray: unrounded scores, nan for sequences which can not be scored
+    :rtype: numpy.ndarray
+    """
+
+    donorArray = loadMesModels(mesScriptDir)[0]
+    codeArray, validArray = encodeSequences(seqList, 9)
+
+    maxEntScore = donorArray[hashCodes(codeArray[:, MES_DONOR_REST].astype(numpy.int64))]
+    consensus = MES_DONOR_CONS1_ARRAY[codeArray[:, 3]] * MES_DONOR_CONS2_ARRAY[codeArray[:, 4]] / (
+        MES_BGD_ARRAY[codeArray[:, 3]] * MES_BGD_ARRAY[codeArray[:, 4]])
+
+    scoreArray = numpy.log(consensus * maxEntScore) / numpy.log(2)
+    scoreArray[~validArray] = numpy.nan
+
+    return scoreArray
+
+def getMesDonorScores(seqList, mesScriptDir):
+
+    """Score 9-mers with the maxentscan 5' donor model (same values as score5.pl)
+
+    :param seqList: list of 9 bases sequences (3 exonic bases + 6 intronic bases)
+    :type seqList: list
+    :param mesScriptDir: path of the maxentscan directory
+    :type mesScriptDir: str
+    :return scoreList: scores rounded to 2 decimals, None for sequences which can not be scored
+    :rtype: list
+    """
+
+    return [roundMesScore(score) for score in getMesDonorScoreArray(seqList, mesScriptDir)]
+
+def getMesAcceptorScoreArray(seqList, mesScriptDir):
+
+    """Score 23-mers with the maxentscan 3' acceptor model in a single vectorized call
+
+    :param seqList: list of 23 bases sequences (20 intronic bases + 3 exonic bases)
+    :type seqList: list
+    :param mesScriptDir: path of the maxentscan directory
+    :type mesScriptDir: str
+    :return scoreArray: unrounded scores, nan for sequences which can not be scored
+    :rtype: numpy.ndarray
+    """
+
+    acceptorList = loadMesModels(mesScriptDir)[1]
+    codeArray, validArray = encodeSequences(seqList, 23)
+
+    restArray = codeArray[:, MES_ACCEPTOR_REST].astype(numpy.int64)
+    sc = [acceptorList[i][hashCodes(restArray[:, start:start + length])]
+        for i, (start, length) in enumerate(MES_ACCEPTOR_HASHES)]
+    maxEntScore = sc[0] * sc[1] * sc[2] * sc[3] * sc[4] / (sc[5] * sc[6] * sc[7] * sc[8])
+    consensus = MES_ACCEPTOR_CONS1_ARRAY[codeArray[:, 18]] * MES_ACCEPTOR_CONS2_ARRAY[codeArray[:, 19]] / (
+        MES_BGD_ARRAY[codeArray[:, 18]] * MES_BGD_ARRAY[codeArray[:, 19]])
 
-    return max(startDistList), median(startDistList), min(startDistList), max(endDistList), median(endDistList), min(endDistList)
+    scoreArray = numpy.log(consensus * maxEntScore) / numpy.log(2)
+    scoreArray[~validArray] = numpy.nan
 
-#def getVarPositionInReads(chrom, pos, BamFile):
-#    pileupIt = BamFile.pileup(chrom, pos, pos + 1)
-#    locationList = list()
-#
-#    for PileupColumn in pileupIt:
-#        for PileupRead in PileupColumn.pileups:
-#            if not PileupRead.alignment.is_secondary and not PileupRead.alignment.is_unmapped and not PileupRead.alignment.mate_is_unmapped and PileupRead.alignment.mate_is_reverse:
+    return scoreArray
 
-def getMesScores(chrom, pos, ref, alt, exonNumber, annotDict, refFasta, prefered_nm, mesScriptDir):
+def getMesAcceptorScores(seqList, mesScriptDir):
+
+    """Score 23-mers with the maxentscan 3' acceptor model (same values as score3.pl)
+
+    :param seqList: list of 23 bases sequences (20 intronic bases + 3 exonic bases)
+    :type seqList: list
+    :param mesScriptDir: path of the maxentscan directory
+    :type mesScriptDir: str
+    :return scoreList: scores rounded to 2 decimals, None for sequences which can not be scored
+    :rtype: list
+    """
+
+    return [roundMesScore(score) for score in getMesAcceptorScoreArray(seqList, mesScriptDir)]
+
+def getMesScores(chrom, pos, ref, alt, exonNumber, transcriptStore, refFasta, prefered_nm, mesScriptDir):
 
     refMesScore = 'NA'
     altMesScore = 'NA'
     deltaMesScore = 'NA'
-    chromAnnotDict = annotDict[chrom]
     if prefered_nm != 'NA':
-        try: 
-            nmDict = chromAnnotDict[prefered_nm]
-        except KeyError:
+        transcript = transcriptStore.getTranscript(chrom, prefered_nm)
+        if transcript is None:
             return "NA", "NA", "NA"
         # get minimum distance from splicing acceptor (index = 0)/donor (index = 1) site
         refSeq = None
         altSeq = None
-        lenExons = len(nmDict['exons'])
-        minDist = None
-        index = None
-        for i in xrange(0, lenExons):
-            exon = nmDict['exons'][i]
-            threePDist = abs(pos - exon[0])
-            fivePDist = abs(pos - exon[1])
-
-            if minDist == None:
-                minDist = min(threePDist, fivePDist)
-                exonNumber = i + 1
-            else:
-                if threePDist < minDist:
-                    index = 0
-                    minDist = threePDist
-                    exonNumber = i + 1
-                if fivePDist < minDist:
-                    index = 1
-                    minDist = fivePDist
-                    exonNumber = i + 1
-
+        minDist, exonIndex, index = transcript.getNearestBoundary(pos)
+        exonNumber = exonIndex + 1
 
-        exon = [elt + 1 for elt in nmDict['exons'][exonNumber - 1]]
+        exon = [elt + 1 for elt in transcript.getExon(exonNumber - 1)]
         threePDist = abs(pos - exon[0])
         fivePDist = abs(pos - exon[1])
 
         # variant impacting acceptor sites
         if threePDist < fivePDist:
-            if nmDict['strand'] == '+':
+            if transcript.strand == '+':
                 dist = pos - exon[0] - 1
                 refSeq = refFasta.fetch(chrom, exon[0] - 21, exon[0] + 2)
 
@@ -509,15 +1678,9 @@ def getMesScores(chrom, pos, ref, alt, exonNumber, annotDict, refFasta, prefered
                             altSeq = refFasta.fetch(chrom, exon[0] - 21, exon[0] + 4 + delSize)
                             altSeq = altSeq[:21 + dist] + alt + altSeq[21 + dist + 1 + delSize:]
 
-                    cmd = "echo " + refSeq + " | perl " + mesScriptDir + "score3.pl /dev/stdin | cut -f2"
-                    process = subprocess.Popen(cmd, stdout = subprocess.PIPE, cwd = mesScriptDir, shell=True)
-                    refMesScore = float(process.stdout.read().rstrip())
+                    refMesScore, altMesScore = getMesAcceptorScores([refSeq, altSeq], mesScriptDir)
 
-                    cmd = "echo " + altSeq + " | perl " + mesScriptDir + "score3.pl /dev/stdin | cut -f2"
-                    process = subprocess.Popen(cmd, stdout = subprocess.PIPE, cwd = mesScriptDir, shell=True)
-                    altMesScore = float(process.stdout.read().rstrip())
-
-            elif nmDict['strand'] == '-':
+            elif transcript.strand == '-':
                 dist = pos - exon[0] - 1
                 refSeq = refFasta.fetch(chrom, exon[0] - 3, exon[0] + 20)
                 #if -3 < dist <= 20:
@@ -545,17 +1708,11 @@ def getMesScores(chrom, pos, ref, alt, exonNumber, annotDict, refFasta, prefered
                     refSeq = refSeq.translate(TRANSLATION_TAB)[::-1]
                     altSeq = altSeq.translate(TRANSLATION_TAB)[::-1]
 
-                    cmd = "echo " + refSeq + " | perl " + mesScriptDir + "score3.pl /dev/stdin | cut -f2"
-                    process = subprocess.Popen(cmd, stdout = subprocess.PIPE, cwd = mesScriptDir, shell=True)
-                    refMesScore = float(process.stdout.read().rstrip())
-
-                    cmd = "echo " + altSeq + " | perl " + mesScriptDir + "score3.pl /dev/stdin | cut -f2"
-                    process = subprocess.Popen(cmd, stdout = subprocess.PIPE, cwd = mesScriptDir, shell=True)
-                    altMesScore = float(process.stdout.read().rstrip())
+                    refMesScore, altMesScore = getMesAcceptorScores([refSeq, altSeq], mesScriptDir)
 
         # variant impacting donor sites
         else:
-            if nmDict['strand'] == '-':
+            if transcript.strand == '-':
                 dist = pos - exon[1] - 1
                 refSeq = refFasta.fetch(chrom, exon[1] - 7, exon[1] + 2)
                 if -7 <= dist < 2:
@@ -581,15 +1738,9 @@ def getMesScores(chrom, pos, ref, alt, exonNumber, annotDict, refFasta, prefered
                     refSeq = refSeq.translate(TRANSLATION_TAB)[::-1]
                     altSeq = altSeq.translate(TRANSLATION_TAB)[::-1]
 
-                    cmd = "echo " + refSeq + " | perl " + mesScriptDir + "score5.pl /dev/stdin | cut -f2"
-                    process = subprocess.Popen(cmd, stdout = subprocess.PIPE, cwd = mesScriptDir, shell=True)
-                    refMesScore = float(process.stdout.read().rstrip())
-
-                    cmd = "echo " + altSeq + " | perl " + mesScriptDir + "score5.pl /dev/stdin | cut -f2"
-                    process = subprocess.Popen(cmd, stdout = subprocess.PIPE, cwd = mesScriptDir, shell=True)
-                    altMesScore = float(process.stdout.read().rstrip())
+                    refMesScore, altMesScore = getMesDonorScores([refSeq, altSeq], mesScriptDir)
                     
-            elif nmDict['strand'] == '+':
+            elif transcript.strand == '+':
                 dist = pos - exon[1] - 1
                 refSeq = refFasta.fetch(chrom, exon[1] - 3, exon[1] + 6)
                 if -3 <= dist < 6:
@@ -613,13 +1764,13 @@ def getMesScores(chrom, pos, ref, alt, exonNumber, annotDict, refFasta, prefered
                             altSeq = refFasta.fetch(chrom, exon[1] - 3, exon[1] + 6 + delSize)
                             altSeq = altSeq[:3 + dist] + alt + altSeq[3 + dist + 1 + delSize:]
 
-                    cmd = "echo " + refSeq + " | perl " + mesScriptDir + "score5.pl /dev/stdin | cut -f2"
-                    process = subprocess.Popen(cmd, stdout = subprocess.PIPE, cwd = mesScriptDir, shell=True)
-                    refMesScore = float(process.stdout.read().rstrip())
+                    refMesScore, altMesScore = getMesDonorScores([refSeq, altSeq], mesScriptDir)
 
-                    cmd = "echo " + altSeq + " | perl " + mesScriptDir + "score5.pl /dev/stdin | cut -f2"
-                    process = subprocess.Popen(cmd, stdout = subprocess.PIPE, cwd = mesScriptDir, shell=True)
-                    altMesScore = float(process.stdout.read().rstrip())
+    # sequences which can not be scored by maxentscan (N bases)
+    if refMesScore is None:
+        refMesScore = 'NA'
+    if altMesScore is None:
+        altMesScore = 'NA'
 
     if refMesScore < 0:
         refMesScore = 0
@@ -634,156 +1785,441 @@ def getMesScores(chrom, pos, ref, alt, exonNumber, annotDict, refFasta, prefered
 
     return refMesScore, altMesScore, deltaMesScore
 
+# raw maxentscan scores of reference windows keyed by (chrom, 0-based window start, window size)
+# a variant scans 32 windows and the variants are annotated in position order, 20000 windows cover the
+# neighbouring variants of several samples in about 10 MB
+MES_REF_WINDOW_CACHE = PersistentCache(maxSize=20000)
+MES_WINDOW_SCORE_FUNCTIONS = {23: getMesAcceptorScoreArray, 9: getMesDonorScoreArray}
+
+def getMesRefWindowScores(chrom, seqStart, refSeq, nWindows, windowSize, mesScriptDir):
+
+    """Raw maxentscan scores of the reference windows refSeq[i:i + windowSize] for i in [0, nWindows[
+
+    The scores of the reference windows are kept for the next variants (see MES_REF_WINDOW_CACHE).
+
+    :param chrom: the chromosome of the sequence
+    :param seqStart: 0-based position of the first base of refSeq
+    :param refSeq: the reference sequence
+    :param nWindows: number of windows
+    :param windowSize: 23 for acceptor sites, 9 for donor sites
+    :param mesScriptDir: path of the maxentscan directory
+    :return scoreArray: unrounded scores, nan for windows which can not be scored
+    :rtype: numpy.ndarray
+    """
+
+    scoreArray = numpy.empty(nWindows)
+    missingList = list()
+    for i in xrange(0, nWindows):
+        cachedScore = MES_REF_WINDOW_CACHE.get((chrom, seqStart + i, windowSize))
+        if cachedScore is None:
+            missingList.append(i)
+        else:
+            scoreArray[i] = cachedScore[0]
+
+    if missingList:
+        missingScoreArray = MES_WINDOW_SCORE_FUNCTIONS[windowSize]([refSeq[i:i + windowSize] for i in missingList], mesScriptDir)
+        for i, score in zip(missingList, missingScoreArray):
+            scoreArray[i] = score
+            MES_REF_WINDOW_CACHE.set((chrom, seqStart + i, windowSize), (score,))
+
+    return scoreArray
+
+def getMesSlidingWindowSequences(chrom, ref, alt, pos, refFasta, windowSize):
+
+    """Reference and alternative sequences scanned by the windows overlapping a variant
+
+    Sequences start windowSize bases before the variant (0-based position pos - windowSize),
+    the variant first base is at index windowSize - 1.
+
+    :return refSeq, altSeq, nWindows: the sequences and the number of windows to score
+    :rtype: tuple
+    """
+
+    anchor = windowSize - 1
+    if len(ref) == 1 and len(alt) == 1:
+        refSeq = refFasta.fetch(chrom, pos - windowSize, pos + windowSize)
+        nWindows = windowSize
+        if ref.upper() != refSeq[anchor].upper():
+            raise Exception('input reference base does not match base in reference genome: position {0} input {1} ref {2}'.format(pos, ref, refSeq[anchor]))
+        altSeq = refSeq[:anchor] + alt + refSeq[windowSize:]
+
+    elif len(ref) > 1: # deletion
+        delSize = len(ref) - len(alt)
+        refSeq = refFasta.fetch(chrom, pos - windowSize, pos + windowSize)
+        altSeq = refFasta.fetch(chrom, pos - windowSize, pos + windowSize + delSize)
+        nWindows = windowSize
+        if ref[0].upper() != refSeq[anchor].upper():
+            raise Exception('input reference base does not match base in reference genome: position {0} input {1} ref {2}'.format(pos, ref, refSeq[anchor]))
+        altSeq = altSeq[:anchor] + alt + altSeq[windowSize + delSize:]
+
+    elif len(alt) > 1: # insertion
+        insSize = len(alt) - len(ref)
+        refSeq = refFasta.fetch(chrom, pos - windowSize, pos + windowSize + insSize)
+        altSeq = refFasta.fetch(chrom, pos - windowSize, pos + windowSize)
+        nWindows = windowSize + insSize
+        if ref.upper() != refSeq[anchor].upper():
+            raise Exception('input reference base does not match base in reference genome: position {0} input {1} ref {2}'.format(pos, ref, refSeq[anchor]))
+        altSeq = altSeq[:anchor] + alt + altSeq[windowSize:]
+
+    return refSeq, altSeq, nWindows
+
 def getMesSlidingWindow(chrom, ref, alt, pos, refFasta, mesScriptDir):
 
-        # acceptor sites
-        if len(ref) == 1 and len(alt) == 1:
-            refSeq = refFasta.fetch(chrom, pos - 23, pos + 23)
-            altSeq = ""
-            swRange = xrange(0,23)
-            if ref.upper() != refSeq[22].upper():
-                raise Exception('input reference base does not match base in reference genome: position {0} input {1} ref {2}'.format(pos, ref, refSeq[22]))
-            else:
-                altSeq = refSeq[:22] + alt + refSeq[23:]
-
-        elif len(ref) > 1: # deletion
-            delSize = len(ref) - len(alt)
-            refSeq = refFasta.fetch(chrom, pos - 23, pos + 23)
-            altSeq = refFasta.fetch(chrom, pos - 23, pos + 23 + delSize)
-            swRange = xrange(0,23)
-            if ref[0].upper() != refSeq[22].upper():
-                raise Exception('input reference base does not match base in reference genome: position {0} input {1} ref {2}'.format(pos, ref, refSeq[22]))
-            else:
-                altSeq = altSeq[:22] + alt + altSeq[23 + delSize:]
-
-        elif len(alt) > 1: # insertion
-            insSize = len(alt) - len(ref)
-            refSeq = refFasta.fetch(chrom, pos - 23, pos + 23 + insSize)
-            altSeq = refFasta.fetch(chrom, pos - 23, pos + 23)
-            if ref.upper() != refSeq[22].upper():
-                raise Exception('input reference base does not match base in reference genome: position {0} input {1} ref {2}'.format(pos, ref, refSeq[22]))
-            else:
-                altSeq = altSeq[:22] + alt + altSeq[23:]
-
-            swRange = xrange(0,23 + insSize)
-
-        refSeqList = list()
-        altSeqList = list()
-        for i in swRange:
-            refSeqList.append(refSeq[i:i+23])
-            altSeqList.append(altSeq[i:i+23])
-            
-        cmd = "echo -e \"" + '\\n'.join(refSeqList) + "\" | perl " + mesScriptDir + "score3.pl /dev/stdin | cut -f2 | tr '\\n' '\t'"
-        process = subprocess.Popen(cmd, stdout = subprocess.PIPE, cwd = mesScriptDir, shell=True)
-        refSWMescoreList = [float(x) for x in process.stdout.read().rstrip().split('\t')]
-        refSWMescoreAcceptor = max(refSWMescoreList)
-
-        cmd = "echo -e \"" + '\\n'.join(altSeqList) + "\" | perl " + mesScriptDir + "score3.pl /dev/stdin | cut -f2 | tr '\\n' '\t'"
-        process = subprocess.Popen(cmd, stdout = subprocess.PIPE, cwd = mesScriptDir, shell=True)
-        altSWMescoreList = [float(x) for x in process.stdout.read().rstrip().split('\t')]
-        altSWMescoreAcceptor = max(altSWMescoreList)
-
-        if refSWMescoreAcceptor < 0:
-            refSWMescoreAcceptor = 0
-        if altSWMescoreAcceptor < 0:
-            altSWMescoreAcceptor = 0
-
-        # donor sites
-        if len(ref) == 1 and len(alt) == 1:
-            refSeq = refFasta.fetch(chrom, pos - 9, pos + 9)
-            altSeq = ""
-            swRange = xrange(0,9)
-            if ref.upper() != refSeq[8].upper():
-                raise Exception('input reference base does not match base in reference genome: position {0} input {1} ref {2}'.format(pos, ref, refSeq[8]))
-            else:
-                altSeq = refSeq[:8] + alt + refSeq[9:]
-
-        elif len(ref) > 1: # deletion
-            delSize = len(ref) - len(alt)
-            refSeq = refFasta.fetch(chrom, pos - 9, pos + 9)
-            altSeq = refFasta.fetch(chrom, pos - 9, pos + 9 + delSize)
-            swRange = xrange(0,9)
-            if ref[0].upper() != refSeq[8].upper():
-                raise Exception('input reference base does not match base in reference genome: position {0} input {1} ref {2}'.format(pos, ref, refSeq[8]))
+    """Maximum maxentscan acceptor and donor scores of the windows overlapping a variant
+
+    Reference windows are scored once per genomic window (see getMesRefWindowScores), alternative
+    windows which end before the first modified base are reference windows and are not rescored.
+
+    :return refSWMescoreAcceptor, altSWMescoreAcceptor, refSWMescoreDonor, altSWMescoreDonor: maximum scores (0 if negative)
+    :rtype: tuple
+    """
+
+    scoreList = list()
+    # acceptor sites (23 bases windows) then donor sites (9 bases windows)
+    for windowSize in (23, 9):
+        refSeq, altSeq, nWindows = getMesSlidingWindowSequences(chrom, ref, alt, pos, refFasta, windowSize)
+        refScoreArray = getMesRefWindowScores(chrom, pos - windowSize, refSeq, nWindows, windowSize, mesScriptDir)
+
+        sharedWindows = max(0, min(nWindows, len(os.path.commonprefix([refSeq, altSeq])) - windowSize + 1))
+        altScoreArray = numpy.empty(nWindows)
+        altScoreArray[:sharedWindows] = refScoreArray[:sharedWindows]
+        altScoreArray[sharedWindows:] = MES_WINDOW_SCORE_FUNCTIONS[windowSize](
+            [altSeq[i:i + windowSize] for i in xrange(sharedWindows, nWindows)], mesScriptDir)
+
+        # windows which can not be scored are skipped, negative scores are reported as 0
+        for scoreArray in (refScoreArray, altScoreArray):
+            maxScore = getMaxMesScore(scoreArray)
+            if maxScore < 0:
+                maxScore = 0
+            scoreList.append(maxScore)
+
+    return tuple(scoreList)
+
+# index of the splice site in the scored windows: first exonic base for acceptors, last exonic base for donors
+MES_SPLICE_SITE_INDEX = {23: 20, 9: 2}
+
+def getMesCrypticScan(chrom, ref, alt, pos, refFasta, flank, mesScriptDir):
+
+    """Scan acceptor and donor sites in the flank bases around a variant
+
+    Reference windows of the whole flank and alternative windows overlapping the variant are scored
+    in batch. Offsets are given on the + strand between the variant position and the splice site
+    (first exonic base of acceptors, last exonic base of donors), deltas are alternative - reference
+    scores of the windows starting at the same position.
+
+    :param flank: number of bases scanned on each side of the variant
+    :return scanList: for acceptor then donor sites: best reference score in the flank and its offset,
+        offset, score and delta of the best new site, offset, score and delta of the best lost site ('NA' if none)
+    :rtype: list
+    """
+
+    varStart = pos - 1
+    scanList = list()
+    for windowSize in (23, 9):
+        siteIndex = MES_SPLICE_SITE_INDEX[windowSize]
+        seqStart = varStart - flank - windowSize + 1
+        left = varStart - seqStart
+        refSeq = refFasta.fetch(chrom, seqStart, varStart + len(ref) + flank + windowSize - 1)
+        if ref.upper() != refSeq[left:left + len(ref)].upper():
+            raise Exception('input reference base does not match base in reference genome: position {0} input {1} ref {2}'.format(pos, ref, refSeq[left:left + len(ref)]))
+        altSeq = refSeq[:left] + alt + refSeq[left + len(ref):]
+
+        nRefWindows = len(refSeq) - windowSize + 1
+        refScoreArray = getMesRefWindowScores(chrom, seqStart, refSeq, nRefWindows, windowSize, mesScriptDir)
+
+        # alternative windows overlapping the variant start from firstWindow to lastWindow - 1,
+        # the other ones are reference windows (shifted by the indel size after the variant)
+        firstWindow = left - windowSize + 1
+        lastWindow = min(left + len(alt), len(altSeq) - windowSize + 1)
+        lastRefWindow = left + len(ref)
+        altScoreArray = numpy.empty(max(lastWindow, lastRefWindow) - firstWindow)
+        altScoreArray.fill(numpy.nan)
+        altScoreArray[:lastWindow - firstWindow] = MES_WINDOW_SCORE_FUNCTIONS[windowSize](
+            [altSeq[k:k + windowSize] for k in xrange(firstWindow, lastWindow)], mesScriptDir)
+        shiftedStart = lastWindow + len(ref) - len(alt)
+        shiftedEnd = min(lastRefWindow + len(ref) - len(alt), nRefWindows)
+        if shiftedEnd > shiftedStart:
+            altScoreArray[lastWindow - firstWindow:lastWindow - firstWindow + shiftedEnd - shiftedStart] = refScoreArray[shiftedStart:shiftedEnd]
+        pairedRefArray = numpy.empty(len(altScoreArray))
+        pairedRefArray.fill(numpy.nan)
+        pairedRefEnd = min(firstWindow + len(altScoreArray), nRefWindows)
+        pairedRefArray[:pairedRefEnd - firstWindow] = refScoreArray[firstWindow:pairedRefEnd]
+
+        # best reference site of the flank
+        if numpy.isnan(refScoreArray).all():
+            scanList.extend(['NA', 'NA'])
+        else:
+            best = numpy.nanargmax(refScoreArray)
+            scanList.extend([roundMesScore(refScoreArray[best]), seqStart + best + siteIndex + 1 - pos])
+
+        # best new site (alternative windows) then best lost site (reference windows)
+        deltaArray = numpy.array([roundMesScore(score) for score in altScoreArray], dtype=float) - numpy.array(
+            [roundMesScore(score) for score in pairedRefArray], dtype=float)
+        for sign, windowEnd, scoreArray in ((1, lastWindow, altScoreArray), (-1, lastRefWindow, pairedRefArray)):
+            signedDeltaArray = sign * deltaArray[:windowEnd - firstWindow]
+            if len(signedDeltaArray) == 0 or numpy.isnan(signedDeltaArray).all() or numpy.nanmax(signedDeltaArray) <= 0:
+                scanList.extend(['NA', 'NA', 'NA'])
             else:
-                altSeq = altSeq[:8] + alt + altSeq[9 + delSize:]
-
-        elif len(alt) > 1: # insertion
-            insSize = len(alt) - len(ref)
-            refSeq = refFasta.fetch(chrom, pos - 9, pos + 9 + insSize)
-            altSeq = refFasta.fetch(chrom, pos - 9, pos + 9)
-            if ref.upper() != refSeq[8].upper():
-                raise Exception('input reference base does not match base in reference genome: position {0} input {1} ref {2}'.format(pos, ref, refSeq[8]))
+                best = numpy.nanargmax(signedDeltaArray)
+                scanList.extend([firstWindow + best + seqStart + siteIndex + 1 - pos, roundMesScore(scoreArray[best]),
+                    float('%.2f' % deltaArray[best])])
+
+    return scanList
+
+def loadESRScores(esrFileName):
+
+    """Load the ESR hexamer scores in a 4096 slots array indexed by 2-bit encoded hexamer
+
+    :param esrFileName: path of the ESRscore.tsv file (hexamer and score on each line)
+    :type esrFileName: str
+    :return esrScoreArray: the score array
+    :rtype: numpy.ndarray
+    """
+
+    with open(esrFileName, 'r') as esrFile:
+        esrLineList = [line.split() for line in esrFile if line.strip()]
+    codeArray, validArray = encodeSequences([lineList[0] for lineList in esrLineList], 6)
+    if not validArray.all() or len(esrLineList) != 4096:
+        raise Exception("invalid ESR score file : " + esrFileName)
+    esrScoreArray = numpy.zeros(4096)
+    esrScoreArray[hashCodes(codeArray)] = [float(lineList[1]) for lineList in esrLineList]
+
+    return esrScoreArray
+
+def getESRSequences(chrom, pos, refSeq, altSeq, refFasta):
+
+    """Reference and alternative 11 bases sequences centered on a variant (alternative is None for long insertions)"""
+
+    # get sequence
+    refSubSeq = refFasta.fetch(chrom, pos - 6, pos +5)
+    refLength = len(refSeq)
+    altLength = len(altSeq)
+
+    # handle indels
+    indelSize = refLength - altLength
+    if refLength != altLength:
+        if indelSize < 0: # insertion
+            # handle long insertions
+            if indelSize <= -12:
+                altSubSeq = None
             else:
-                altSeq = altSeq[:8] + alt + altSeq[9:]
-
-            swRange = xrange(0,9 + insSize)
-
-        refSeqList = list()
-        altSeqList = list()
-        for i in swRange:
-            refSeqList.append(refSeq[i:i+9])
-            altSeqList.append(altSeq[i:i+9])
-            
-        cmd = "printf \"" + '\\n'.join(refSeqList) + "\" | perl " + mesScriptDir + "score5.pl /dev/stdin | cut -f2 | tr '\\n' '\t'"
-        process = subprocess.Popen(cmd, stdout = subprocess.PIPE, cwd = mesScriptDir, shell=True)
-        refSWMescoreList = [float(x) for x in process.stdout.read().rstrip().split('\t')]
-        refSWMescoreDonor = max(refSWMescoreList)
-
-        cmd = "printf \"" + '\\n'.join(altSeqList) + "\" | perl " + mesScriptDir + "score5.pl /dev/stdin | cut -f2 | tr '\\n' '\t'"
-        process = subprocess.Popen(cmd, stdout = subprocess.PIPE, cwd = mesScriptDir, shell=True)
-        altSWMescoreList = [float(x) for x in process.stdout.read().rstrip().split('\t')]
-        altSWMescoreDonor = max(altSWMescoreList)
-
-        if refSWMescoreDonor < 0:
-            refSWMescoreDonor = 0
-        if altSWMescoreDonor < 0:
-            altSWMescoreDonor = 0
-
-        return refSWMescoreAcceptor, altSWMescoreAcceptor, refSWMescoreDonor, altSWMescoreDonor
-
-def getESRScore(chrom, pos, refSeq, altSeq, esrScoreDict, refFasta):
-
-        # get sequence
-        refSubSeq = refFasta.fetch(chrom, pos - 6, pos +5)
-        refLength = len(refSeq)
-        altLength = len(altSeq)
-
-        # handle indels
-        indelSize = refLength - altLength
-        if refLength != altLength:
-            if indelSize < 0: # insertion
-                # handle long insertions
-                if indelSize <= -12:
-                    altSubSeq = None
-                else:
-                    indelSubSeqList = list(refFasta.fetch(chrom, pos - 6, pos + 5 + indelSize))
-                    altSubSeq = ''.join(indelSubSeqList[:5]) + altSeq + ''.join(indelSubSeqList[6:])
-            else: # deletion
                 indelSubSeqList = list(refFasta.fetch(chrom, pos - 6, pos + 5 + indelSize))
-                altSubSeq = ''.join(indelSubSeqList[:6]) + ''.join(indelSubSeqList[6 + indelSize:])
-        # handle snv
-        else:
-            altSubSeq = refSubSeq[:5] + altSeq + refSubSeq[6:]
-
-        if altSubSeq != None:
-            refScoreList = list()
-            altScoreList = list()
-            for i in xrange(0, len(refSubSeq) - 5):
-                refHexamer = refSubSeq[i:i+6].upper()
-                altHexamer = altSubSeq[i:i+6].upper()
-                refESRscore = esrScoreDict[refHexamer]
-                altESRscore = esrScoreDict[altHexamer]
-                refScoreList.append(refESRscore)
-                altScoreList.append(altESRscore)
-
-            refScore = max(refScoreList)
-            altScore = max(altScoreList)
-            delta = altESRscore / refESRscore
+                altSubSeq = ''.join(indelSubSeqList[:5]) + altSeq + ''.join(indelSubSeqList[6:])
+        else: # deletion
+            indelSubSeqList = list(refFasta.fetch(chrom, pos - 6, pos + 5 + indelSize))
+            altSubSeq = ''.join(indelSubSeqList[:6]) + ''.join(indelSubSeqList[6 + indelSize:])
+    # handle snv
+    else:
+        altSubSeq = refSubSeq[:5] + altSeq + refSubSeq[6:]
 
+    return refSubSeq, altSubSeq
+
+def getESRScores(variantList, esrScoreArray, refFasta):
+
+    """Score a batch of variants with the ESR hexamer scores (Ke et al. 2011)
+
+    The 6 hexamers overlapping each variant are scored in one vectorized lookup.
+
+    :param variantList: list of (chrom, pos, ref, alt) tuples
+    :type variantList: list
+    :param esrScoreArray: the array returned by loadESRScores
+    :type esrScoreArray: numpy.ndarray
+    :return scoreList: list of (refScore, altScore, delta) tuples with the maximum hexamer scores
+        and their difference, 'NA' when no hexamer can be scored
+    :rtype: list
+    """
+
+    if len(variantList) == 0:
+        return list()
+
+    hexamerList = list()
+    for chrom, pos, refSeq, altSeq in variantList:
+        refSubSeq, altSubSeq = getESRSequences(chrom, pos, refSeq, altSeq, refFasta)
+        if altSubSeq is None:
+            altSubSeq = ''
+        hexamerList.extend([refSubSeq[i:i + 6] for i in xrange(0, 6)])
+        hexamerList.extend([altSubSeq[i:i + 6] for i in xrange(0, 6)])
+
+    codeArray, validArray = encodeSequences(hexamerList, 6)
+    scoreArray = numpy.where(validArray, esrScoreArray[hashCodes(codeArray)], -numpy.inf)
+    maxScoreArray = scoreArray.reshape(len(variantList), 2, 6).max(axis=2)
+
+    scoreList = list()
+    for refScore, altScore in maxScoreArray:
+        refScore = float(refScore) if refScore != -numpy.inf else "NA"
+        altScore = float(altScore) if altScore != -numpy.inf else "NA"
+        if refScore != "NA" and altScore != "NA":
+            delta = altScore - refScore
         else:
-            altScore = "NA"
             delta = "NA"
+        scoreList.append((refScore, altScore, delta))
+
+    return scoreList
+
+def getESRScore(chrom, pos, refSeq, altSeq, esrScoreArray, refFasta):
+
+    """Score a single variant with the ESR hexamer scores, see getESRScores"""
+
+    return getESRScores([(chrom, pos, refSeq, altSeq)], esrScoreArray, refFasta)[0]
+
+# precomputed annotation of all possible snv (see build_snv_table.py)
+# ref is the reference base, nm is the index of the prefered nm used for canonical maxentscan scores in the nm list of the index file (-1 if none)
+SNV_TABLE_FIELDS = [
+    'mes_ref', 'mes_alt', 'mes_delta',
+    'mes_cryptic_acceptor_wt', 'mes_cryptic_acceptor_mut', 'mes_cryptic_donor_wt', 'mes_cryptic_donor_mut',
+    'esr_ref', 'esr_alt', 'esr_delta'
+]
+if numpy is not None:
+    # int_fields : bit i is set when SNV_TABLE_FIELDS[i] was an int (maxentscan scores clamped to 0)
+    SNV_TABLE_DTYPE = numpy.dtype([('ref', 'S1'), ('nm', numpy.int32), ('int_fields', numpy.uint16)] + [(field, numpy.float64) for field in SNV_TABLE_FIELDS])
+
+def getSnvAltBases(refBase):
+
+    """The 3 alternative bases of a reference base, in the order used in the snv table"""
+
+    return [base for base in 'ACGT' if base != refBase.upper()]
+
+class SnvTable(object):
+
+    """Read access to a precomputed snv annotation table (prefix.npy memory-mapped and prefix.idx)
+
+    Each panel position holds 3 records, one for each alternative base (see getSnvAltBases).
+
+    :param prefix: path prefix of the table files
+    :type prefix: str
+    """
+
+    def __init__(self, prefix):
+        self.nmList = list()
+        self.regionDict = dict()
+        with open(prefix + '.idx', 'r') as idxFile:
+            for line in idxFile:
+                lineList = line.rstrip('\n').split('\t')
+                if lineList[0] == '#nm':
+                    self.nmList = lineList[1:]
+                elif not line.startswith('#'):
+                    chrom, start, end, offset = lineList[0], int(lineList[1]), int(lineList[2]), int(lineList[3])
+                    self.regionDict.setdefault(chrom, ([], [], []))
+                    for valueList, value in zip(self.regionDict[chrom], (start, end, offset)):
+                        valueList.append(value)
+        self.recordArray = numpy.load(prefix + '.npy', mmap_mode='r')
+        if self.recordArray.dtype != SNV_TABLE_DTYPE:
+            raise ValueError("{0}.npy was built by another version of build_snv_table.py, it must be rebuilt".format(prefix))
+
+    def lookup(self, chrom, pos, ref, alt):
+
+        """Return the precomputed values of a snv as a dict ('NA' for missing values, 'nm' is the prefered nm or 'NA')
+        or None if the variant is not in the table"""
+
+        if len(ref) != 1 or len(alt) != 1 or chrom not in self.regionDict:
+            return None
+        if ref.upper() not in 'ACGT' or alt.upper() not in getSnvAltBases(ref):
+            return None
+
+        startList, endList, offsetList = self.regionDict[chrom]
+        i = bisect.bisect_right(startList, pos - 1) - 1
+        if i < 0 or pos - 1 >= endList[i]:
+            return None
+
+        record = self.recordArray[offsetList[i] + (pos - 1 - startList[i]) * 3 + getSnvAltBases(ref).index(alt.upper())]
+        # a reference base different from the genome is handled (and reported) by the live computation
+        if record['ref'] != ref.upper():
+            return None
+
+        valueDict = dict()
+        for i, field in enumerate(SNV_TABLE_FIELDS):
+            value = float(record[field])
+            if numpy.isnan(value):
+                value = "NA"
+            elif record['int_fields'] >> i & 1:
+                value = int(value)
+            valueDict[field] = value
+        valueDict['nm'] = self.nmList[record['nm']] if record['nm'] >= 0 else "NA"
+
+        return valueDict
+
+class BedIndex(object):
+
+    """Index of bed regions for position queries in O(log n)
+
+    The regions of each chromosome are cut in elementary intervals at their boundaries, each elementary interval
+    holding the names of the regions which cover it (in the order of the regions).
+
+    :param regionList: list of (chrom, start, end, name) with 1-based start and end included
+    :type regionList: list
+    """
+
+    def __init__(self, regionList):
+        chromRegionDict = dict()
+        for chrom, start, end, name in regionList:
+            chromRegionDict.setdefault(chrom, list()).append((start, end, name))
+
+        # chrom -> (sorted interval starts, names of the regions covering each interval)
+        self.chromDict = dict()
+        for chrom, chromRegionList in chromRegionDict.items():
+            startDict = dict()
+            endDict = dict()
+            for regionIndex, (start, end, name) in enumerate(chromRegionList):
+                startDict.setdefault(start, list()).append(regionIndex)
+                endDict.setdefault(end + 1, list()).append(regionIndex)
+
+            boundaryList = sorted(set(startDict.keys()) | set(endDict.keys()))
+            nameList = list()
+            activeSet = set()
+            for boundary in boundaryList:
+                activeSet.difference_update(endDict.get(boundary, []))
+                activeSet.update(startDict.get(boundary, []))
+                nameList.append(tuple(chromRegionList[regionIndex][2] for regionIndex in sorted(activeSet)))
+            self.chromDict[chrom] = (boundaryList, nameList)
+
+    def getNames(self, chrom, pos):
+
+        """Return the names of the regions covering a position (empty tuple if there is none)"""
+
+        if chrom not in self.chromDict:
+            return ()
+        boundaryList, nameList = self.chromDict[chrom]
+        i = bisect.bisect_right(boundaryList, pos) - 1
+        if i < 0:
+            return ()
+
+        return nameList[i]
+
+    def overlaps(self, chrom, pos):
+
+        """Return True if a region covers the position"""
+
+        return len(self.getNames(chrom, pos)) != 0
+
+    def getMergedRegions(self, chrom):
+
+        """Return the sorted list of (start, end) of the positions covered by at least one region (1-based, end
+        included), overlapping and adjacent regions being merged"""
+
+        mergedRegionList = list()
+        if chrom not in self.chromDict:
+            return mergedRegionList
+        boundaryList, nameList = self.chromDict[chrom]
+        for i, names in enumerate(nameList):
+            if len(names) == 0:
+                continue
+            if mergedRegionList and mergedRegionList[-1][1] == boundaryList[i] - 1:
+                mergedRegionList[-1][1] = boundaryList[i + 1] - 1
+            else:
+                mergedRegionList.append([boundaryList[i], boundaryList[i + 1] - 1])
+
+        return [tuple(region) for region in mergedRegionList]
+
+def indexPileup(pileupFileName):
+
+    """Compress a samtools mpileup file with bgzip and index it with tabix, for region seeks in check_variants.py
+
+    The pileup must be sorted by chromosome and position (as written by samtools mpileup).
+
+    :param pileupFileName: the pileup file (kept)
+    :return: the name of the compressed file (pileupFileName + '.gz', indexed in pileupFileName + '.gz.tbi')
+    """
 
-        return refScore, altScore, delta
+    import pysam
 
+    return pysam.tabix_index(pileupFileName, seq_col=0, start_col=1, end_col=1, zerobased=False, force=True, keep_original=True)
@@ -0,0 +1,139 @@
+#! /usr/bin/env python
+# -*- coding: utf8 -*-
+
+# This file is part of table_maker.py
+
+# Copyright Institut Curie 2014
+
+# This software is a computer program whose purpose is to MaxEntScan scores.
+
+# This software is governed by the CeCILL license under French law and
+# abiding by the rules of distribution of free software.  You can  use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# "http://www.cecill.info".
+
+# As a counterpart to the access to the source code and  rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty  and the software's author,  the holder of the
+# economic rights,  and the successive licensors  have only  limited
+# liability.
+
+# In this respect, the user's attention is drawn to the risks associated
+# with loading,  using,  modifying and/or developing or reproducing the
+# software by the user in light of its specific status of free software,
+# that may mean  that it is complicated to manipulate,  and  that  also
+# therefore means  that it is reserved for developers  and  experienced
+# professionals having in-depth computer knowledge. Users are therefore
+# encouraged to load and test the software's suitability as regards their
+# requirements in conditions enabling the security of their systems and/or
+# data to be ensured and,  more generally, to use and operate it in the
+# same conditions as regards security.
+
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+import os, sys, random, shutil, subprocess, tempfile, unittest, logging
+import pysam
+
+PACKAGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, PACKAGE_DIR)
+import clinTools
+
+# exons (1-based, inclusive) of a + strand and a - strand transcript on a random chromosome
+TRANSCRIPT_LIST = [
+    ('NM_000001', 'GENE1', '+', [(1000, 1200), (2000, 2100), (3000, 3300)]),
+    ('NM_000002', 'GENE2', '-', [(8000, 8150), (9000, 9100), (10000, 10200)])
+]
+# bed regions (0-based) around exon boundaries of both transcripts, the first two overlap
+BED_REGION_LIST = [('chr1', 1180, 1230), ('chr1', 1190, 1210), ('chr1', 1985, 2010), ('chr1', 8990, 9020)]
+
+
+class SnvTableTest(unittest.TestCase):
+
+    """Compare the values of a table built by build_snv_table.py with the live computation of table_maker.py"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpDir = tempfile.mkdtemp()
+        rng = random.Random(8)
+        seqList = [rng.choice('ACGTacgt') for i in xrange(12000)]
+        # acceptor sites (polypyrimidine tract and AG) and donor sites (GTAAGT) around the exons
+        for nm, gene, strand, exonList in TRANSCRIPT_LIST:
+            for start, end in exonList:
+                if strand == '+':
+                    seqList[start - 19:start - 1] = [rng.choice('CT') for i in xrange(16)] + ['A', 'G']
+                    seqList[end:end + 6] = 'GTAAGT'
+                else:
+                    seqList[start - 7:start - 1] = 'ACTTAC'
+                    seqList[end:end + 18] = ['C', 'T'] + [rng.choice('AG') for i in xrange(16)]
+        with open(os.path.join(cls.tmpDir, 'ref.fa'), 'w') as fastaFile:
+            fastaFile.write('>chr1\n' + ''.join(seqList) + '\n')
+        pysam.faidx(os.path.join(cls.tmpDir, 'ref.fa'))
+        with open(os.path.join(cls.tmpDir, 'annot.gtf'), 'w') as gtfFile:
+            for nm, gene, strand, exonList in TRANSCRIPT_LIST:
+                for start, end in exonList:
+                    gtfFile.write('\t'.join(['chr1', 'hg19_refGene', 'exon', str(start), str(end), '0', strand, '.',
+                        'gene_id "{0}"; transcript_id "{1}";'.format(gene, nm)]) + '\n')
+        with open(os.path.join(cls.tmpDir, 'prefered_nm.conf'), 'w') as nmFile:
+            nmFile.write(''.join(nm + '\n' for nm, gene, strand, exonList in TRANSCRIPT_LIST))
+        with open(os.path.join(cls.tmpDir, 'panel.bed'), 'w') as bedFile:
+            bedFile.write(''.join('\t'.join([chrom, str(start), str(end)]) + '\n' for chrom, start, end in BED_REGION_LIST))
+
+        subprocess.check_call([sys.executable, os.path.join(PACKAGE_DIR, 'build_snv_table.py')] +
+            [os.path.join(cls.tmpDir, fileName) for fileName in ['panel.bed', 'prefered_nm.conf', 'annot.gtf', 'ref.fa', 'panel_snv']])
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpDir)
+
+    def testTableMatchesLiveValues(self):
+        logging.disable(logging.WARNING)
+        snvTable = clinTools.SnvTable(os.path.join(self.tmpDir, 'panel_snv'))
+        refFasta = pysam.Fastafile(os.path.join(self.tmpDir, 'ref.fa'))
+        transcriptStore = clinTools.loadChrGtf(os.path.join(self.tmpDir, 'annot.gtf'))
+        mesScriptDir = os.path.join(PACKAGE_DIR, 'maxentscan/')
+        esrScoreArray = clinTools.loadESRScores(os.path.join(PACKAGE_DIR, 'score_tables', 'ESRscore.tsv'))
+
+        variantList = list()
+        for chrom, start, end in BED_REGION_LIST:
+            for pos in xrange(start + 1, end + 1):
+                refBase = refFasta.fetch(chrom, pos - 1, pos).upper()
+                variantList.extend([(chrom, pos, refBase, altBase) for altBase in clinTools.getSnvAltBases(refBase)])
+
+        nInt = 0
+        nFloatZero = 0
+        for variant, esrScores in zip(variantList, clinTools.getESRScores(variantList, esrScoreArray, refFasta)):
+            chrom, pos, refBase, altBase = variant
+            snvRecord = snvTable.lookup(*variant)
+            self.assertIsNotNone(snvRecord, variant)
+
+            preferedNm = [nm for nm, gene, strand, exonList in TRANSCRIPT_LIST if exonList[0][0] <= pos <= exonList[-1][1]][-1]
+            self.assertEqual(snvRecord['nm'], preferedNm)
+            liveList = list(clinTools.getMesScores(chrom, pos, refBase, altBase, "NA", transcriptStore, refFasta, preferedNm, mesScriptDir))
+            try:
+                liveList.extend(clinTools.getMesSlidingWindow(chrom, refBase, altBase, pos, refFasta, mesScriptDir))
+            except ValueError:
+                liveList.extend([0, 0, 0, 0])
+            liveList.extend(esrScores)
+
+            tableList = [snvRecord[field] for field in clinTools.SNV_TABLE_FIELDS]
+            # same values and same types, the output columns are written with str()
+            self.assertEqual([str(value) for value in tableList], [str(value) for value in liveList], variant)
+            nInt += len([value for value in tableList if isinstance(value, int)])
+            nFloatZero += len([value for value in tableList if isinstance(value, float) and value == 0])
+
+        # the regions hold clamped maxentscan scores (int 0) and null deltas (float 0.0), both types are checked
+        self.assertTrue(nInt > 0)
+        self.assertTrue(nFloatZero > 0)
+
+    def testOutsidePanel(self):
+        snvTable = clinTools.SnvTable(os.path.join(self.tmpDir, 'panel_snv'))
+        refFasta = pysam.Fastafile(os.path.join(self.tmpDir, 'ref.fa'))
+        refBase = refFasta.fetch('chr1', 5000, 5001).upper()
+        self.assertIsNone(snvTable.lookup('chr1', 5001, refBase, clinTools.getSnvAltBases(refBase)[0]))
+        self.assertIsNone(snvTable.lookup('chr2', 1181, 'A', 'C'))
+
+
+if __name__ == '__main__':
+    unittest.main()